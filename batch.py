@@ -0,0 +1,97 @@
+import os
+import re
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import plot
+
+# headless batch mode, renders every plot of a gene list for one organism and tissue:
+#   python batch.py genes.txt --organism human --organ intestine --out plots --formats png,pdf --workers 8
+
+FORMATS = ["png", "svg", "pdf"]
+
+_datasets = None
+
+
+def read_genes(path):
+    """genes from a text file, one per line (commas, spaces and semicolons also separate), upper-cased and de-duplicated"""
+    with open(path) as f:
+        genes = [gene for gene in re.split(r'[\s,;]+', f.read().upper()) if gene]
+    return list(dict.fromkeys(genes))
+
+
+def plot_filename(directory, organism, organ, gene, index, ext):
+    """same naming scheme as App.save_cur_plot, index starts at 1"""
+    return f'{directory}/{organism}_{organ}_{gene}_{index}.{ext}'
+
+
+def _init_worker(path):
+    global _datasets
+    plot.use_manifest(path)
+    _datasets = plot.lazy_datasets(path, mmap=True)
+    plot.reuse_figure()  # one figure per worker, cleared between plots
+
+
+def render_gene(gene, organism, organ, directory, formats):
+    """renders and saves every plot of gene, returns the number of plots (0 if no dataset has the gene)"""
+    count = 0
+    for name, plot_fn, args in plot.plot_jobs(organism, organ):
+        fig = plot.render(name, plot_fn, args, gene, _datasets, figure_cache=None)
+        if fig is None:
+            continue
+        count += 1
+        for ext in formats:  # the figure is reused by the next plot, so it is saved right away
+            fig.savefig(plot_filename(directory, organism, organ, gene, count, ext))
+    return count
+
+
+def run_batch(genes, organism, organ, directory, formats=("png",), workers=None, path=r'datasets'):
+    """renders the plots of all genes in parallel worker processes. returns {gene: number of plots}"""
+    os.makedirs(directory, exist_ok=True)
+    plot.use_manifest(path)
+    # build the binary caches once here, so the workers only memory map them
+    for name, _, _ in plot.plot_jobs(organism, organ):
+        plot.load_dataset(name, path, mmap=True)
+    workers = workers or os.cpu_count()
+    job = partial(render_gene, organism=organism, organ=organ, directory=directory, formats=formats)
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_worker, initargs=(path,)) as pool:
+        counts = pool.map(job, genes, chunksize=max(1, len(genes) // (workers * 4)))
+        return dict(zip(genes, counts))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="render the plots of a list of genes without the GUI")
+    parser.add_argument("genes", help="text file with gene names")
+    parser.add_argument("--organism", choices=plot.ORGANISMS, required=True)
+    parser.add_argument("--organ", choices=plot.TISSUES, required=True)
+    parser.add_argument("--out", default="plots", help="output folder")
+    parser.add_argument("--formats", default="png", help=f"comma separated, any of {','.join(FORMATS)}")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: number of cores)")
+    parser.add_argument("--datasets", default="datasets", help="datasets folder")
+    args = parser.parse_args()
+
+    formats = [ext.strip().lower() for ext in args.formats.split(",") if ext.strip()]
+    unknown = set(formats) - set(FORMATS)
+    if unknown:
+        parser.error(f"unknown formats: {', '.join(sorted(unknown))}")
+    genes = read_genes(args.genes)
+    if not genes:
+        parser.error(f"no genes in {args.genes}")
+
+    start = time.perf_counter()
+    counts = run_batch(genes, args.organism, args.organ, args.out, formats, args.workers, args.datasets)
+    elapsed = time.perf_counter() - start
+
+    n_plots = sum(counts.values())
+    missing = [gene for gene, count in counts.items() if count == 0]
+    print(f"rendered {n_plots} plots ({n_plots * len(formats)} files) for {len(genes)} genes in {elapsed:.1f}s: "
+          f"{n_plots / elapsed:.1f} plots/s")
+    if missing:
+        print(f"not found in any dataset ({len(missing)}): {', '.join(missing[:20])}{' ...' if len(missing) > 20 else ''}")
+
+
+if __name__ == "__main__":
+    main()
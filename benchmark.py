@@ -0,0 +1,158 @@
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+import matplotlib
+matplotlib.use("Agg")
+import plot
+import registry
+import cache
+
+# benchmarks the load, lookup and render hot paths on synthetic datasets shaped like the real ones:
+#   python benchmark.py --genes 20000 --celltypes 40 --save baseline.json
+#   python benchmark.py --genes 20000 --celltypes 40 --compare baseline.json
+# timings are the best of --repeat runs, in seconds. --compare exits with 1 if a timing got slower than the tolerance
+
+SECTIONS = 5  # rows per gene of the datasets with a 'section' id column
+HPA_ORGANS = 8
+TOLERANCE = 1.5  # slower than baseline * TOLERANCE is a regression
+MIN_SECONDS = 1e-4  # timings below this are too noisy to compare
+
+
+def make_datasets(directory, n_genes, n_celltypes, seed=0):
+    """writes a synthetic csv for every registry dataset, with its layout, id and value columns"""
+    rng = np.random.default_rng(seed)
+    genes = np.array([f"G{i}" for i in range(n_genes - 3)] + ["GAPDH", "RPS14", "ACTB"])
+    celltypes = np.array([f"celltype{i}" for i in range(n_celltypes)])
+    for spec in registry.DATASETS.values():
+        if spec.layout == "long":
+            n = len(genes) * n_celltypes
+            df = pd.DataFrame({"gene": np.repeat(genes, n_celltypes), spec.var_name: np.tile(celltypes, len(genes)),
+                               spec.value_name: rng.random(n).round(4)})
+            if spec.kind == "hpa":
+                df["organ"] = np.tile([f"organ{i % HPA_ORGANS}" for i in range(n_celltypes)], len(genes))
+            df = df.sample(frac=1, random_state=seed)  # the real long files are not grouped by gene
+        else:
+            repeats = SECTIONS if len(spec.id_vars) > 1 else 1
+            df = pd.DataFrame(rng.random((len(genes) * repeats, n_celltypes)).round(4), columns=celltypes)
+            df.insert(0, "gene", np.repeat(genes, repeats))
+            for col in spec.id_vars[1:]:
+                df.insert(1, col, np.tile(np.arange(1, repeats + 1), len(genes)))
+        df.to_csv(os.path.join(directory, spec.file), index=False)
+
+
+def timed(fn, repeat=5):
+    """best wall time of fn over repeat calls, the least disturbed by other load on the machine"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def calibrate(repeat=5):
+    """a fixed python + numpy workload, --compare scales the baseline by how fast this machine runs it now"""
+    values = np.random.default_rng(0).random(200_000)
+    return timed(lambda: (sorted(values[:50_000].tolist()), np.sort(values), {i: str(i) for i in range(50_000)}), repeat)
+
+
+def run(directory, repeat=5, lookups=1000):
+    """returns {timing name: seconds}"""
+    results = {"calibration": calibrate(repeat)}
+    shutil.rmtree(os.path.join(directory, cache.CACHE_DIR), ignore_errors=True)
+    tables = {}
+    for name in registry.DATASETS:
+        start = time.perf_counter()
+        tables[name] = registry.load_dataset(name, directory)  # parses the csv and builds the binary cache
+        results[f"load.cold.{name}"] = time.perf_counter() - start
+        results[f"load.warm.{name}"] = timed(lambda: registry.load_dataset(name, directory), repeat)
+
+    rng = np.random.default_rng(1)
+    for name, table in tables.items():
+        hits = [table.genes[i] for i in rng.integers(0, len(table), lookups)]
+        results[f"lookup.hit.{name}"] = timed(lambda: [table.get(gene) for gene in hits], repeat) / lookups
+        results[f"lookup.miss.{name}"] = timed(lambda: [table.get(f"MISSING{i}") for i in range(lookups)], repeat) / lookups
+
+    for organism in plot.ORGANISMS:
+        for organ in plot.TISSUES:
+            if plot.plot_jobs(organism, organ):
+                results[f"make_plots.{organism}.{organ}"] = timed(
+                    lambda: plot.make_plots(organism, organ, "GAPDH", tables, figure_cache=None), repeat)
+
+    for kind, plot_fn in plot.PLOT_KINDS.items():
+        spec = next((spec for spec in registry.DATASETS.values() if spec.kind == kind), None)
+        if spec is None:
+            continue
+        args = plot.job_args(spec)
+        results[f"render.{kind}"] = timed(lambda: plot_fn(tables[spec.name], "GAPDH", *args), repeat)
+        fig = plot_fn(tables[spec.name], "GAPDH", *args)
+        results[f"draw.{kind}"] = timed(fig.canvas.draw, repeat)  # the Agg render FigureCanvasTkAgg.draw does
+    return results
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """prints every timing next to its baseline, returns the names of the regressions.
+    baseline timings are scaled by the calibration ratio, so a slower or busier machine is not a regression"""
+    regressions = []
+    speed = results["calibration"] / baseline["calibration"] if baseline.get("calibration") else 1
+    print(f"machine speed vs baseline: {1 / speed:.2f}x")
+    print(f"{'timing':<45}{'baseline':>12}{'now':>12}{'ratio':>8}")
+    for name, seconds in results.items():
+        before = baseline.get(name)
+        if before is None:
+            print(f"{name:<45}{'':>12}{seconds:>12.3g}{'new':>8}")
+            continue
+        ratio = seconds / (before * speed) if before > 0 else float('inf')
+        slower = ratio > tolerance and max(seconds, before) >= MIN_SECONDS
+        if slower:
+            regressions.append(name)
+        print(f"{name:<45}{before:>12.3g}{seconds:>12.3g}{ratio:>7.2f}{' !' if slower else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark loading, gene lookups and rendering on synthetic datasets")
+    parser.add_argument("--genes", type=int, default=5000)
+    parser.add_argument("--celltypes", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=5, help="runs per timing, the best is reported")
+    parser.add_argument("--dir", default=None, help="folder for the synthetic datasets (default: a temporary one)")
+    parser.add_argument("--save", default=None, help="write the timings to this json file")
+    parser.add_argument("--compare", default=None, help="compare against timings saved with --save")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    args = parser.parse_args()
+
+    directory = args.dir or tempfile.mkdtemp(prefix="plotter-bench-")
+    os.makedirs(directory, exist_ok=True)
+    registry.use_manifest(directory)  # the built-in datasets only, no manifest in the synthetic folder
+    try:
+        make_datasets(directory, args.genes, args.celltypes)
+        results = run(directory, args.repeat)
+    finally:
+        if args.dir is None:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    meta = {"genes": args.genes, "celltypes": args.celltypes}
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({"meta": meta, "timings": results}, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            saved = json.load(f)
+        if saved["meta"] != meta:
+            print(f"warning: baseline was run with {saved['meta']}, this run with {meta}")
+        regressions = compare(results, saved["timings"], args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} regressions: {', '.join(regressions)}")
+            raise SystemExit(1)
+    else:
+        for name, seconds in results.items():
+            print(f"{name:<45}{seconds:>12.3g}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,308 @@
+import os
+import json
+import shutil
+import threading
+import hashlib
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow.feather as feather
+except ImportError:  # without pyarrow the cache falls back to pickle files
+    feather = None
+
+CACHE_DIR = '.cache'
+CACHE_VERSION = 3  # bump when the cached layout changes, invalidates every cache file
+HASH_CHUNK = 1 << 20
+
+
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def source_key(path, tag=''):
+    """cheap identity of a source file, the hash is only added when the cache is built"""
+    st = os.stat(path)
+    return {"version": CACHE_VERSION, "tag": tag, "mtime": st.st_mtime_ns, "size": st.st_size}
+
+
+def cache_paths(path, tag='', ext=None):
+    """returns (data path, meta file) for the cache of path, in a cache folder next to it"""
+    directory, file = os.path.split(path)
+    stem = f'{file}.{tag}' if tag else file
+    if ext is None:
+        ext = 'feather' if feather is not None else 'pkl'
+    cache_dir = os.path.join(directory, CACHE_DIR)
+    return os.path.join(cache_dir, f'{stem}.{ext}'), os.path.join(cache_dir, f'{stem}.json')
+
+
+def is_valid(path, meta_file, tag=''):
+    """True if meta_file describes the current content of path. a touched file with the same size is re-hashed"""
+    try:
+        meta = _read_json(meta_file)
+    except (OSError, ValueError):
+        return False
+    key = source_key(path, tag)
+    if any(meta.get(k) != key[k] for k in ("version", "tag", "size")):
+        return False
+    if meta.get("mtime") == key["mtime"]:
+        return True
+    if meta.get("sha1") != file_hash(path):
+        return False
+    meta["mtime"] = key["mtime"]  # same content, new mtime: skip the hash next time
+    _write_json(meta_file, meta)
+    return True
+
+
+def _read_json(meta_file):
+    with open(meta_file) as f:
+        return json.load(f)
+
+
+def _write_json(meta_file, meta):
+    tmp = f'{meta_file}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp, meta_file)
+
+
+def _write_frame(df, data_file):
+    tmp = f'{data_file}.{os.getpid()}.tmp'
+    if feather is not None:
+        # uncompressed so the file can be memory mapped on read
+        feather.write_feather(df.reset_index(drop=True), tmp, compression='uncompressed')
+    else:
+        df.to_pickle(tmp)
+    os.replace(tmp, data_file)
+
+
+def _read_frame(data_file, memory_map=True):
+    if feather is not None:
+        return feather.read_feather(data_file, memory_map=memory_map)
+    return pd.read_pickle(data_file)
+
+
+def cached_frame(path, build, tag='', memory_map=True):
+    """returns build(path), going through a binary cache that is rebuilt whenever the source file changes.
+    tag separates different builds of the same source file"""
+    data_file, meta_file = cache_paths(path, tag)
+    if os.path.exists(data_file) and is_valid(path, meta_file, tag):
+        try:
+            return _read_frame(data_file, memory_map)
+        except Exception as e:  # corrupt / partially written cache, rebuild it
+            print(f"ignoring broken cache {data_file}: {e}")
+    key = source_key(path, tag)
+    df = build(path)
+    try:
+        os.makedirs(os.path.dirname(data_file), exist_ok=True)
+        _write_frame(df, data_file)
+        key["sha1"] = file_hash(path)
+        _write_json(meta_file, key)
+    except OSError as e:  # read-only dataset folder: work without the cache
+        print(f"could not write cache {data_file}: {e}")
+    return df
+
+
+def cached_arrays(path, build, tag='', mmap_mode=None):
+    """like cached_frame, for builds that return (arrays, attrs): a dict of numpy arrays, kept as one .npy file each,
+    and a json-able dict of extra attributes. returns (arrays, attrs)"""
+    data_dir, meta_file = cache_paths(path, tag, ext='npy')
+    if os.path.isdir(data_dir) and is_valid(path, meta_file, tag):
+        try:
+            meta = _read_json(meta_file)
+            return _load_arrays(data_dir, meta["arrays"], mmap_mode), meta["attrs"]
+        except Exception as e:
+            print(f"ignoring broken cache {data_dir}: {e}")
+    key = source_key(path, tag)
+    arrays, attrs = build(path)
+    try:
+        _save_arrays(data_dir, arrays)
+        key.update(sha1=file_hash(path), arrays=list(arrays), attrs=attrs)
+        _write_json(meta_file, key)
+    except OSError as e:
+        print(f"could not write cache {data_dir}: {e}")
+    return arrays, attrs
+
+
+def cached_stream(path, build, tag='', mmap_mode='r'):
+    """like cached_arrays, for sources bigger than memory: build(path, data_dir) writes its arrays as .npy files
+    into data_dir itself (e.g. chunk by chunk through np.lib.format.open_memmap) and returns the attrs.
+    returns (arrays, attrs) with the arrays memory mapped. needs a writable cache folder"""
+    data_dir, meta_file = cache_paths(path, tag, ext='npy')
+    if os.path.isdir(data_dir) and is_valid(path, meta_file, tag):
+        try:
+            meta = _read_json(meta_file)
+            return _load_arrays(data_dir, meta["arrays"], mmap_mode), meta["attrs"]
+        except Exception as e:
+            print(f"ignoring broken cache {data_dir}: {e}")
+    key = source_key(path, tag)
+    tmp_dir = f'{data_dir}.{os.getpid()}.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    attrs = build(path, tmp_dir)
+    names = sorted(file[:-len('.npy')] for file in os.listdir(tmp_dir) if file.endswith('.npy'))
+    shutil.rmtree(data_dir, ignore_errors=True)
+    os.replace(tmp_dir, data_dir)
+    key.update(sha1=file_hash(path), arrays=names, attrs=attrs)
+    _write_json(meta_file, key)
+    return _load_arrays(data_dir, names, mmap_mode), attrs
+
+
+def _load_arrays(data_dir, names, mmap_mode=None):
+    return {name: np.load(os.path.join(data_dir, f'{name}.npy'), mmap_mode=mmap_mode) for name in names}
+
+
+def _save_arrays(data_dir, arrays):
+    os.makedirs(data_dir, exist_ok=True)
+    for name, values in arrays.items():
+        tmp = os.path.join(data_dir, f'{name}.npy.{os.getpid()}.tmp')  # render workers may build the same cache at once
+        with open(tmp, 'wb') as f:
+            np.save(f, values, allow_pickle=False)
+        os.replace(tmp, os.path.join(data_dir, f'{name}.npy'))
+
+
+def remove_scratch(cache_dir, pids):
+    """removes the temporary files and folders (*.<pid>.tmp, also inside the .npy folders) that the processes pids
+    left in cache_dir when they were killed mid-write"""
+    suffixes = tuple(f'.{pid}.tmp' for pid in pids)
+    if not suffixes or not os.path.isdir(cache_dir):
+        return
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith(suffixes):
+            _remove(entry.path)
+        elif entry.is_dir():
+            for inner in os.scandir(entry.path):
+                if inner.name.endswith(suffixes):
+                    _remove(inner.path)
+
+
+def _remove(path):
+    try:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    except OSError as e:
+        print(f"could not remove {path}: {e}")
+
+
+def group_key(paths):
+    """identity (mtime, size) of a set of source files, missing files are left out"""
+    files = {}
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        files[os.path.basename(path)] = [st.st_mtime_ns, st.st_size]
+    return {"version": CACHE_VERSION, "files": files}
+
+
+def load_group(directory, name, paths, mmap_mode=None):
+    """(arrays, attrs) that save_group stored for the same source files, or None if any of them changed since"""
+    data_dir, meta_file = os.path.join(directory, CACHE_DIR, f'{name}.npy'), os.path.join(directory, CACHE_DIR, f'{name}.json')
+    try:
+        meta = _read_json(meta_file)
+        if {k: meta[k] for k in ("version", "files")} != group_key(paths):
+            return None
+        return _load_arrays(data_dir, meta["arrays"], mmap_mode), meta["attrs"]
+    except Exception:  # missing, stale or broken
+        return None
+
+
+def save_group(directory, name, paths, arrays, attrs):
+    """caches arrays derived from several source files (e.g. an index over all datasets)"""
+    data_dir, meta_file = os.path.join(directory, CACHE_DIR, f'{name}.npy'), os.path.join(directory, CACHE_DIR, f'{name}.json')
+    try:
+        _save_arrays(data_dir, arrays)
+        _write_json(meta_file, dict(group_key(paths), arrays=list(arrays), attrs=attrs))
+    except OSError as e:
+        print(f"could not write cache {data_dir}: {e}")
+
+
+class ImageCache:
+    """rendered images on disk, each file named by the sha1 of everything the image depends on (its key),
+    so a changed dataset or style simply addresses new files. the least recently used files are deleted
+    once the folder grows past max_mb"""
+
+    def __init__(self, directory, max_mb=256):
+        self.directory = directory
+        self.max_bytes = max_mb * 2 ** 20
+        self.hits = self.misses = 0
+        self._nbytes = None  # summed on first use
+        self._lock = threading.Lock()
+
+    def path(self, key, ext):
+        digest = hashlib.sha1(json.dumps([CACHE_VERSION, key], sort_keys=True).encode()).hexdigest()
+        return os.path.join(self.directory, digest[:2], f'{digest}.{ext}')
+
+    def get(self, key, ext='png'):
+        """the cached bytes, or None"""
+        path = self.path(key, ext)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)  # the mtime is the last use, for eviction
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data
+
+    def put(self, key, data, ext='png'):
+        path = self.path(key, ext)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"could not write cache {path}: {e}")
+            return
+        with self._lock:
+            if self._nbytes is None:
+                self._size()  # the first walk already counts the new file
+            else:
+                self._nbytes += len(data)
+            if self._nbytes > self.max_bytes:
+                self._evict()
+
+    def _size(self):
+        if self._nbytes is None:
+            self._nbytes = sum(size for _, size, _ in self._files())
+        return self._nbytes
+
+    def _files(self):
+        """[(mtime, size, path)] of the cached files"""
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((st.st_mtime_ns, st.st_size, path))
+        return files
+
+    def _evict(self):
+        """deletes the least recently used files down to 90% of max_bytes"""
+        files = sorted(self._files())
+        self._nbytes = sum(size for _, size, _ in files)
+        for _, size, path in files:
+            if self._nbytes <= self.max_bytes * .9:
+                break
+            try:
+                os.remove(path)
+                self._nbytes -= size
+            except OSError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "mb": round(self._size() / 2 ** 20, 1)}
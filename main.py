@@ -2,10 +2,16 @@ import customtkinter as ctk
 from tkinter import messagebox
 from tkinter import filedialog as fd
 import plot
+import registry
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 import pandas as pd
 from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+import queue
+import re
+import time
+from timing import TIMINGS, BUCKETS_MS
 
 
 PLOT_SIZE = plot.PLOT_SIZE
@@ -16,6 +22,15 @@ FONT_SIZE_WIDGET = 18
 TEXT_SIZE = (20, 2)
 WIDGET_SIZE = (140, 40)
 LABEL_MAX_LEN = 12
+WARM_DATASETS = True  # load the datasets with the eager load policy in the background once the window is up
+WARM_THREADS = 3  # datasets read at once by the warm-up
+WARM_PROCESSES = None  # processes that parse csvs without a binary cache during the warm-up (None: one per core, 0: none)
+WARM_POLL_MS = 250  # how often the dataset progress label is updated during the warm-up
+STOP_TIMEOUT = 2  # seconds quitting waits for the warm-up threads and the plot saver
+POLL_MS = 30  # how often the Tk thread picks up plots rendered in the background
+RENDER_PROCESSES = 0  # >0 renders the plots of a query in parallel worker processes instead of one background thread
+PREFETCH_RECENT = 5  # recently used genes that are rendered ahead when the organism / tissue changes
+RENDER_CACHE_MB = 256  # rendered plots kept on disk across sessions (datasets/.cache/renders), 0 turns it off
 
 
 class App:
@@ -38,6 +53,8 @@ class App:
         root.bind_all('<Up>', lambda event: self.callback_previous())
         root.bind_all('<Down>', lambda event: self.callback_next())
         root.bind_all("<Return>", lambda event: self.callback_generate())
+        root.bind_all('<Next>', lambda event: self.callback_next_gene())
+        root.bind_all('<Prior>', lambda event: self.callback_previous_gene())
         for i in range(1, 10):
             root.bind_all(f"{i}", partial(self.callback_numkeys, i))
 
@@ -49,28 +66,48 @@ class App:
         self.cur_plot = self.create_empty_plot()
         self.plots = [self.cur_plot]
         self.gene = None
+        self.gene_queue = []  # genes typed into the entry (comma / space separated), cycled with PageUp / PageDown
+        self.queue_index = 0
+        self.recent_genes = []
+        self.symbols = plot.cached_symbol_index()  # gene index + presence bitmap, None until built after the warm-up
+        self.suggestions = []
         self.empty_plot = self.create_empty_plot(gene_not_found=True)
         self.plot_index = 0
         self.messages = ['  -  ' * 11]
 
+        # plots are rendered off the Tk thread and handed back through self.results
+        self.executor = ThreadPoolExecutor(max_workers=max(1, RENDER_PROCESSES), thread_name_prefix="plotter")
+        self.pool = plot.render_pool(workers=RENDER_PROCESSES) if RENDER_PROCESSES else None
+        self.results = queue.Queue()
+        self.generation = 0  # bumped on every Generate, results of older generations are dropped
+        self.pending = []
+        self.jobs_total = self.jobs_done = 0
+
         self.frame_controls = ctk.CTkFrame(master=self.root)
         self.frame_plot = ctk.CTkFrame(master=self.root)
         self.frame_extra = ctk.CTkFrame(master=self.root)
 
         self.label_organism = ctk.CTkLabel(self.frame_controls, text="Organism: ",
                                            width=TEXT_SIZE[0], height=TEXT_SIZE[1], font=ctk.CTkFont(family=FONT, size=FONT_SIZE_LABEL))
-        self.optionmenu_organism = ctk.CTkOptionMenu(master=self.frame_controls, values=plot.ORGANISMS,
+        self.optionmenu_organism = ctk.CTkOptionMenu(master=self.frame_controls, values=plot.ORGANISMS, command=self.callback_options_query,
                                                      width=WIDGET_SIZE[0], height=WIDGET_SIZE[1], font=ctk.CTkFont(family=FONT, size=FONT_SIZE_WIDGET))
         self.label_organ = ctk.CTkLabel(self.frame_controls, text="Tissue: ",
                                         width=TEXT_SIZE[0], height=TEXT_SIZE[1], font=ctk.CTkFont(family=FONT, size=FONT_SIZE_LABEL))
-        self.optionmenu_organ = ctk.CTkOptionMenu(self.frame_controls, values=plot.TISSUES,
+        self.optionmenu_organ = ctk.CTkOptionMenu(self.frame_controls, values=plot.TISSUES, command=self.callback_options_query,
                                                   width=WIDGET_SIZE[0], height=WIDGET_SIZE[1], font=ctk.CTkFont(family=FONT, size=FONT_SIZE_WIDGET))
         self.label_gene = ctk.CTkLabel(self.frame_controls, text="Gene: ",
                                        width=TEXT_SIZE[0], height=TEXT_SIZE[1], font=ctk.CTkFont(family=FONT, size=FONT_SIZE_LABEL))
         self.entry = ctk.CTkEntry(master=self.frame_controls, placeholder_text="Gene",
                                   width=WIDGET_SIZE[0], height=WIDGET_SIZE[1], font=ctk.CTkFont(family=FONT, size=FONT_SIZE_WIDGET))
+        self.entry.bind('<KeyRelease>', self.callback_entry_typed)
+        self.entry.bind('<Tab>', self.callback_complete)
+        self.label_suggest = ctk.CTkLabel(self.frame_controls, text="", justify="left", wraplength=2 * WIDGET_SIZE[0],
+                                          font=ctk.CTkFont(family=FONT, size=FONT_SIZE_WIDGET - 4))
         self.button_generate = ctk.CTkButton(master=self.frame_controls, command=self.callback_generate, text="Generate",
                                              width=WIDGET_SIZE[0], height=WIDGET_SIZE[1], font=ctk.CTkFont(family=FONT, size=FONT_SIZE_WIDGET))
+        self.progressbar = ctk.CTkProgressBar(master=self.frame_controls, width=WIDGET_SIZE[0])
+        self.progressbar.set(0)
+        self.label_queue = ctk.CTkLabel(self.frame_controls, text="", font=ctk.CTkFont(family=FONT, size=FONT_SIZE_WIDGET - 4))
 
         self.button_next = ctk.CTkButton(master=self.frame_plot, command=self.callback_next, text="Next",
                                          width=220, height=WIDGET_SIZE[1], font=ctk.CTkFont(family=FONT, size=FONT_SIZE_WIDGET))
@@ -84,6 +121,15 @@ class App:
                                          width=520, height=WIDGET_SIZE[1], font=ctk.CTkFont(family=FONT, size=FONT_SIZE_WIDGET))
         self.switch_save = ctk.CTkSwitch(master=self.frame_plot, command=self.callback_switch_save, text="Remember output folder",
                                          width=280, height=WIDGET_SIZE[1], font=ctk.CTkFont(family=FONT, size=FONT_SIZE_WIDGET))
+        self.label_cache = ctk.CTkLabel(self.frame_extra, text="", font=ctk.CTkFont(family=FONT, size=FONT_SIZE_WIDGET - 4))
+        self.label_datasets = ctk.CTkLabel(self.frame_extra, text="", font=ctk.CTkFont(family=FONT, size=FONT_SIZE_WIDGET - 4))
+        self.switch_panel = ctk.CTkSwitch(master=self.frame_extra, text="Gene panel heatmap",
+                                          width=280, height=WIDGET_SIZE[1], font=ctk.CTkFont(family=FONT, size=FONT_SIZE_WIDGET))
+        self.switch_compare = ctk.CTkSwitch(master=self.frame_extra, text="Compare all datasets",
+                                            width=280, height=WIDGET_SIZE[1], font=ctk.CTkFont(family=FONT, size=FONT_SIZE_WIDGET))
+        self.button_diagnostics = ctk.CTkButton(master=self.frame_extra, command=self.callback_diagnostics, text="Diagnostics",
+                                                width=WIDGET_SIZE[0], height=WIDGET_SIZE[1], font=ctk.CTkFont(family=FONT, size=FONT_SIZE_WIDGET))
+        self.window_diagnostics = None
 
         self.frame_controls.grid(column=0, row=1, rowspan=7, columnspan=2, padx=20, pady=20)
         self.frame_plot.grid(column=3, row=1, rowspan=7, columnspan=4, padx=20, pady=20)
@@ -95,15 +141,32 @@ class App:
         self.label_gene.grid(column=0, row=3, padx=20, pady=20)
         self.entry.grid(column=1, row=3, padx=20, pady=20)
         self.button_generate.grid(column=1, row=4, padx=20, pady=20)
+        self.progressbar.grid(column=1, row=5, padx=20, pady=(0, 20))
+        self.label_queue.grid(column=1, row=6, padx=20, pady=(0, 20))
+        self.label_suggest.grid(column=0, row=7, columnspan=2, padx=20, pady=(0, 20))
         self.button_previous.grid(column=1, row=1, padx=20, pady=20)
         self.button_next.grid(column=2, row=1, padx=20, pady=20)
         self.optionmenu_plot.grid(column=3, row=1, padx=20, pady=20)
         self.switch_theme.grid(column=0, row=7, rowspan=2, padx=20, pady=20)
+        self.label_cache.grid(column=0, row=9, padx=20, pady=(0, 10))
+        self.switch_panel.grid(column=0, row=10, padx=20, pady=(0, 20))
+        self.switch_compare.grid(column=0, row=11, padx=20, pady=(0, 20))
+        self.button_diagnostics.grid(column=0, row=12, padx=20, pady=(0, 20))
+        self.label_datasets.grid(column=0, row=13, padx=20, pady=(0, 10))
         self.button_save.grid(column=1, row=7, columnspan=2, padx=5, pady=20)
         self.switch_save.grid(column=3, row=7, padx=20, pady=20)
 
-        self.datasets = plot.import_datasets()
+        # memory mapped when the workers render: what the warm-up and the prefetcher load here shares their page cache
+        self.datasets = plot.lazy_datasets(mmap=self.pool is not None)
+        self.image_cache = plot.image_cache(max_mb=RENDER_CACHE_MB) if RENDER_CACHE_MB else None
+        self.prefetcher = plot.Prefetcher(self.datasets, image_cache=self.image_cache, pool=self.pool)
         self.draw_plot()
+        self.cache_builder = None
+        if registry.MANIFEST_ERROR:
+            self.root.after(0, lambda: messagebox.showerror("Manifest", f"showing the built-in datasets only, could not read\n{registry.MANIFEST_ERROR}"))
+        if WARM_DATASETS:
+            self.root.after(500, self.warm_datasets)
+        self.root.after(POLL_MS, self.poll_results)
 
     def callback_switch_theme(self):
         opt = 'dark' if self.switch_theme.get() else 'light'
@@ -111,7 +174,8 @@ class App:
 
     @staticmethod
     def create_empty_plot(gene_not_found=False):
-        fig, ax = plt.subplots(figsize=PLOT_SIZE)
+        fig = Figure(figsize=PLOT_SIZE)
+        ax = fig.subplots()
         text = "Gene not found" if gene_not_found else "Welcome to Roy's plotter"
         ax.text(0.5, 0.5, text, ha='center', va='center', fontsize=26, color='red')
         ax.axis('off')
@@ -119,27 +183,121 @@ class App:
         return fig
 
     def create_plots(self,):
-        self.plots, self.names = plot.make_plots(self.optionmenu_organism.get(), self.optionmenu_organ.get(), self.gene, self.datasets)
+        """starts rendering the plots of the current query in the background, cancelling the previous query"""
+        self.generation += 1
+        for future in self.pending:
+            future.cancel()
+        self.prefetcher.pause()
+        plot.IMAGE_SAVER.pause()
+        if isinstance(self.gene, tuple):  # a panel of genes, one heatmap per dataset
+            jobs = plot.panel_jobs(self.optionmenu_organism.get(), self.optionmenu_organ.get())
+        else:
+            if self.gene in self.recent_genes:
+                self.recent_genes.remove(self.gene)
+            self.recent_genes = [self.gene] + self.recent_genes[:PREFETCH_RECENT - 1]
+            if self.switch_compare.get() == 1:  # one figure of the gene in every dataset, whatever the organism and tissue
+                jobs = plot.compare_jobs()
+            else:
+                # only datasets that hold the gene, a missing gene renders nothing and loads nothing
+                jobs = plot.holding_jobs(plot.plot_jobs(self.optionmenu_organism.get(), self.optionmenu_organ.get()), self.gene, self.symbols)
         print('options: ', self.optionmenu_organism.get(), self.optionmenu_organ.get(), self.gene)
-        print("generated ", len(self.plots), ' plots')
+        self.plots, self.names = [], []
+        self.jobs_total, self.jobs_done = len(jobs), 0
+        self.button_save.configure(state="disabled")
+        self.optionmenu_plot.configure(state="disabled")
+        self.progressbar.set(0)
+        self.query_start = time.perf_counter()
+        self.pending = [self.executor.submit(self.render_job, self.generation, job, self.gene) for job in jobs]
+        if not jobs:
+            self.finish_plots()
+
+    def render_job(self, generation, job, gene):
+        """runs on the worker thread. figures come from plot.new_figure (Agg), so no Tk call happens here"""
+        if generation != self.generation:  # a newer query was started
+            return
+        name, plot_fn, args = job
+        try:
+            if name == plot.COMPARE_NAME:  # reads every dataset, skipping the ones the symbol index rules out
+                fig = plot_fn(self.datasets, gene, presence=self.symbols)
+            elif self.pool is None:
+                fig = plot.render(name, plot_fn, args, gene, self.datasets, image_cache=self.image_cache)
+            else:  # create_plots dropped the datasets the symbol index rules out, the worker returns None for a missing gene
+                fig = plot.submit_render(self.pool, name, plot_fn, args, gene, image_cache=self.image_cache).result()
+        except Exception as e:
+            print(f"failed plotting {name}: {e}")
+            fig = None
+        self.results.put((generation, name, fig))
+
+    def poll_results(self):
+        """runs on the Tk thread, shows every plot as soon as it is ready"""
+        while True:
+            try:
+                generation, name, fig = self.results.get_nowait()
+            except queue.Empty:
+                break
+            if generation != self.generation:
+                continue
+            self.jobs_done += 1
+            self.progressbar.set(self.jobs_done / self.jobs_total)
+            if fig is not None:
+                self.add_plot(name, fig)
+            if self.jobs_done == self.jobs_total:
+                self.finish_plots()
+        self.root.after(POLL_MS, self.poll_results)
+
+    def add_plot(self, name, fig):
+        self.plots.append(fig)
+        self.names.append(name)
+        self.optionmenu_plot.configure(state="normal", values=self.names)
+        self.button_save.configure(state="normal")
+        if len(self.plots) == 1:
+            self.plot_index = 0
+            self.cur_plot = fig
+            self.optionmenu_plot.set(name)
+            self.draw_plot()
+        else:
+            self.update_nav_buttons()
+
+    def finish_plots(self):
+        print(f"generated {len(self.plots)} plots in {(time.perf_counter() - self.query_start) * 1000:.0f} ms")
+        self.pending = []
+        self.progressbar.set(1)
+        self.prefetcher.resume()
+        plot.IMAGE_SAVER.resume()
+        self.prefetch()
         if not self.plots:
-            self.button_save.configure(state="disabled")
             self.names = ["plot"]
             self.optionmenu_plot.configure(state="disabled", values=self.names)
+            self.optionmenu_plot.set(self.names[0])
             self.plots = [self.empty_plot]
             self.gene = None
-        else:
-            self.button_save.configure(state="normal")
-            self.optionmenu_plot.configure(state="normal", values=self.names)
-        self.plot_index = 0
-        self.cur_plot = self.plots[self.plot_index]
-        self.optionmenu_plot.set(self.names[self.plot_index])
-        self.draw_plot()
+            self.plot_index = 0
+            self.cur_plot = self.empty_plot
+            self.draw_plot()
+        self.update_cache_label()
+
+    def update_cache_label(self):
+        stats = plot.FIGURE_CACHE.stats()
+        text = f"plot cache: {stats['hits']} hits, {stats['misses']} misses ({stats['figures']} plots, {stats['mb']} MB)"
+        if self.image_cache is not None:
+            disk = self.image_cache.stats()
+            text += f"\ndisk: {disk['hits']} hits, {disk['misses']} misses ({disk['mb']} MB)"
+        self.label_cache.configure(text=text)
 
     def draw_plot(self):
-        self.canvas = FigureCanvasTkAgg(self.cur_plot, master=self.frame_plot)
-        self.canvas.draw()
-        self.canvas.get_tk_widget().grid(column=1, row=2, columnspan=3, rowspan=5, padx=20, pady=20)
+        # one canvas for the whole session, figures are swapped into it instead of gridding a new widget per draw
+        if self.canvas is None:
+            self.canvas = FigureCanvasTkAgg(self.cur_plot, master=self.frame_plot)
+            self.canvas.get_tk_widget().grid(column=1, row=2, columnspan=3, rowspan=5, padx=20, pady=20)
+        elif self.canvas.figure is not self.cur_plot:
+            self.cur_plot.set_dpi(self.canvas.figure.dpi)  # keep the screen scaling the canvas applied to the first figure
+            self.canvas.figure = self.cur_plot
+            self.cur_plot.set_canvas(self.canvas)
+        with TIMINGS.timed("draw", self.names[self.plot_index] if self.names else ''):
+            self.canvas.draw()
+        self.update_nav_buttons()
+
+    def update_nav_buttons(self):
         if self.plot_index == 0:
             self.button_previous.configure(state="disabled")
         else:
@@ -149,12 +307,110 @@ class App:
         else:
             self.button_next.configure(state="normal")
 
+    def prefetch(self):
+        """renders the next genes of the queue, then the recent ones, while the user looks at the current plot"""
+        upcoming = self.gene_queue[self.queue_index + 1:] + self.gene_queue[:self.queue_index]
+        self.prefetcher.prefetch(self.optionmenu_organism.get(), self.optionmenu_organ.get(), upcoming + self.recent_genes)
+
+    def callback_options_query(self, value):
+        self.datasets.prioritize(self.selected_datasets())
+        self.prefetch()
+
+    def selected_datasets(self):
+        return [name for name, _, _ in plot.plot_jobs(self.optionmenu_organism.get(), self.optionmenu_organ.get())]
+
+    def warm_datasets(self):
+        """loads the datasets of the selected organism and tissue, then the eager ones, on WARM_THREADS threads.
+        csvs without a binary cache are parsed in WARM_PROCESSES processes. queries run meanwhile"""
+        if WARM_PROCESSES != 0:
+            self.cache_builder = plot.CacheBuilder(processes=WARM_PROCESSES)
+        names = self.selected_datasets() + plot.eager_datasets()
+        self.datasets.warm(names, then=self.warm_done, threads=WARM_THREADS, prepare=self.cache_builder)
+        self.update_datasets_label()
+
+    def warm_done(self):
+        """runs on the last warm-up thread"""
+        if self.cache_builder is not None:
+            self.cache_builder.close()
+        self.build_symbol_index()
+
+    def update_datasets_label(self):
+        """per-dataset warm-up progress, polled on the Tk thread until every queued dataset is loaded"""
+        loaded, total, loading = self.datasets.progress()
+        failed = [name for name, state in self.datasets.status.items() if state == 'failed']
+        text = f"datasets: {loaded}/{total} loaded"
+        if loading:
+            text += f"\nloading {', '.join(loading)}"
+        if failed:
+            text += f"\nfailed: {', '.join(failed)}"
+        self.label_datasets.configure(text=text)
+        if loaded < total:
+            self.root.after(WARM_POLL_MS, self.update_datasets_label)
+
+    def build_symbol_index(self):
+        """runs on the warm-up thread, only when no index was cached for the current datasets"""
+        if self.symbols is not None:
+            return
+        self.symbols = plot.symbol_index(self.datasets)
+        print(f"symbol index: {len(self.symbols)} symbols in {len(self.symbols.names)} datasets")
+
+    def callback_entry_typed(self, event):
+        """prefix completion of the last gene typed, and the datasets that hold it"""
+        if self.symbols is None:
+            return
+        token = re.split(r'[\s,;]+', self.entry.get())[-1]
+        self.suggestions = self.symbols.complete(token, limit=6)
+        if not token:
+            self.label_suggest.configure(text="")
+            return
+        found = self.symbols.datasets_of(self.symbols.resolve(token))
+        if found:
+            found_text = f"in: {', '.join(found)}"
+        else:
+            found_text = "" if self.suggestions else f"{token.upper()} is not in any dataset"
+        self.label_suggest.configure(text=f"{', '.join(self.suggestions)}\n{found_text}".strip())
+
+    def callback_complete(self, event):
+        """Tab replaces the last gene typed with its first completion"""
+        if not self.suggestions:
+            return
+        text = self.entry.get()
+        token = re.split(r'[\s,;]+', text)[-1]
+        self.entry.delete(len(text) - len(token), "end")
+        self.entry.insert("end", self.suggestions[0])
+        self.callback_entry_typed(event)
+        return "break"
+
     def callback_generate(self):
-        self.gene = self.entry.get().upper().strip()
-        if not self.gene:
+        genes = [gene for gene in re.split(r'[\s,;]+', self.entry.get().upper()) if gene]
+        if not genes:
+            return
+        if self.symbols is not None:
+            genes = [self.symbols.resolve(gene) for gene in genes]
+        if self.switch_panel.get() == 1 and len(genes) > 1:
+            self.gene_queue, self.queue_index = [], 0
+            self.gene = tuple(dict.fromkeys(genes))
+            self.label_queue.configure(text=f"panel of {len(self.gene)} genes")
+            self.create_plots()
             return
+        self.gene_queue = genes
+        self.show_gene(0)
+
+    def show_gene(self, index):
+        self.queue_index = index
+        self.gene = self.gene_queue[index]
+        queue_text = f"gene {index + 1}/{len(self.gene_queue)} (PageUp / PageDown)" if len(self.gene_queue) > 1 else ""
+        self.label_queue.configure(text=queue_text)
         self.create_plots()
 
+    def callback_next_gene(self):
+        if self.queue_index < len(self.gene_queue) - 1:
+            self.show_gene(self.queue_index + 1)
+
+    def callback_previous_gene(self):
+        if self.queue_index > 0:
+            self.show_gene(self.queue_index - 1)
+
     def callback_options_plots(self, value):
         self.plot_index = self.names.index(value)
         self.cur_plot = self.plots[self.plot_index]
@@ -200,17 +456,61 @@ class App:
 
     def save_cur_plot(self, directory):
         """saves the current plot"""
-        name = f'{self.optionmenu_organism.get()}_{self.optionmenu_organ.get()}_{self.gene}_{self.plot_index+1}'
+        gene = f'panel{len(self.gene)}' if isinstance(self.gene, tuple) else self.gene
+        name = f'{self.optionmenu_organism.get()}_{self.optionmenu_organ.get()}_{gene}_{self.plot_index+1}'
         filename = f'{directory}/{name}.png'
-        self.cur_plot.savefig(filename)
+        with TIMINGS.timed("save", self.names[self.plot_index]):
+            png = getattr(self.cur_plot, 'png', None)
+            if png is None:
+                self.cur_plot.savefig(filename)
+            else:  # a plot from the disk cache, its png is written as it was rendered
+                with open(filename, 'wb') as f:
+                    f.write(png)
         print(f"saved: {filename}")
 
+    def callback_diagnostics(self):
+        """window with the per-stage, per-dataset timings of this session"""
+        if self.window_diagnostics is not None and self.window_diagnostics.winfo_exists():
+            self.window_diagnostics.focus()
+            self.update_diagnostics()
+            return
+        window = ctk.CTkToplevel(self.root)
+        window.title("Diagnostics")
+        self.textbox_diagnostics = ctk.CTkTextbox(window, width=760, height=420, font=ctk.CTkFont(family="Courier", size=13))
+        self.textbox_diagnostics.grid(column=0, row=0, columnspan=3, padx=20, pady=20)
+        ctk.CTkButton(window, text="Refresh", command=self.update_diagnostics).grid(column=0, row=1, padx=20, pady=(0, 20))
+        ctk.CTkButton(window, text="Export JSON", command=self.callback_export_timings).grid(column=1, row=1, padx=20, pady=(0, 20))
+        ctk.CTkButton(window, text="Clear", command=lambda: (TIMINGS.clear(), self.update_diagnostics())).grid(column=2, row=1, padx=20, pady=(0, 20))
+        self.window_diagnostics = window
+        self.update_diagnostics()
+
+    def update_diagnostics(self):
+        lines = [f"{'stage':<13}{'dataset':<25}{'count':>6}{'mean ms':>10}{'max ms':>10}  histogram"]
+        for row in TIMINGS.summary():
+            lines.append(f"{row['stage']:<13}{row['dataset'][:24]:<25}{row['count']:>6}{row['mean_ms']:>10.1f}{row['max_ms']:>10.1f}  {row['histogram']}")
+        lines.append(f"\nhistogram buckets (ms): <={', <='.join(map(str, BUCKETS_MS))}, more")
+        self.textbox_diagnostics.configure(state="normal")
+        self.textbox_diagnostics.delete("1.0", "end")
+        self.textbox_diagnostics.insert("1.0", "\n".join(lines))
+        self.textbox_diagnostics.configure(state="disabled")
+
+    def callback_export_timings(self):
+        filename = fd.asksaveasfilename(defaultextension=".json", initialfile="timings.json", filetypes=[("JSON", "*.json")])
+        if filename:
+            TIMINGS.export(filename)
+            print(f"saved: {filename}")
+
     def callback_switch_save(self):
         if self.switch_save.get() == 0:
             self.output_dir = None
 
     def quit_attempt(self):
         if messagebox.askokcancel("Quit", "Quit?"):
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.datasets.stop(timeout=STOP_TIMEOUT)  # also kills a csv parse the warm-up waits on
+            plot.IMAGE_SAVER.stop(timeout=STOP_TIMEOUT)
+            if self.pool is not None:
+                self.pool.shutdown(wait=False, cancel_futures=True)
             self.root.destroy()
 
 
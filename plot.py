@@ -1,239 +1,654 @@
+import numpy as np
 import pandas as pd
 import seaborn as sns
-import matplotlib.pyplot as plt
+import matplotlib
+import matplotlib.image
+from matplotlib.figure import Figure
+from matplotlib.collections import LineCollection, PolyCollection
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import io
+import pickle
+import threading
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from collections import OrderedDict, deque
+from store import DatasetRegistry, SymbolIndex, WideTable, load_aliases
+from registry import DATASETS, load_dataset, import_datasets, lazy_datasets, eager_datasets, use_manifest, CacheBuilder
+import cache
+from timing import TIMINGS
 
 PLOT_SIZE = (9, 6)
 TISSUES = ["all tissues", "pancreas", "intestine", "liver", "thyroid"]
 ORGANISMS = ["mouse", "human"]
+HEATMAP_MAX_LABELS = 80  # bigger panels drop the gene labels
+COMPARE_NAME = "all datasets"  # plot name of the comparison of one gene across every dataset
+COMPARE_COLUMNS = 4  # small multiples per row
+ALIASES_FILE = 'gene_aliases.csv'  # optional, columns alias, symbol
+BAR_COLOR = sns.desaturate('blue', .75)  # how sns.barplot draws color='blue' (saturation .75)
+# organisms and tissues that only manifest datasets have
+ORGANISMS += [organism for organism in dict.fromkeys(spec.organism for spec in DATASETS.values()) if organism not in ORGANISMS]
+TISSUES += [organ for organ in dict.fromkeys(spec.organ for spec in DATASETS.values()) if organ not in TISSUES]
+
+
+def _index_sources(path):
+    return [f'{path}/{spec.file}' for spec in DATASETS.values()] + [f'{path}/{ALIASES_FILE}']
+
+
+def symbol_index(datasets, path=r'datasets'):
+    """builds the SymbolIndex, with its gene x dataset presence bitmap, over the datasets (only the already loaded
+    ones of a DatasetRegistry) and saves it, so later launches get it from cached_symbol_index"""
+    names = datasets.loaded if isinstance(datasets, DatasetRegistry) else list(datasets)
+    index = SymbolIndex.from_tables({name: datasets[name] for name in names}, load_aliases(f'{path}/{ALIASES_FILE}'))
+    cache.save_group(path, 'symbols', _index_sources(path), *index.to_arrays())
+    return index
+
+
+def cached_symbol_index(path=r'datasets'):
+    """the SymbolIndex saved by symbol_index, or None if a dataset csv changed since. no dataset is loaded"""
+    cached = cache.load_group(path, 'symbols', _index_sources(path))
+    return None if cached is None else SymbolIndex.from_arrays(*cached)
+
+
+class FigureCache:
+    """LRU cache of rendered figures keyed on (dataset, gene, plot function, style), bounded by count and memory"""
+
+    def __init__(self, max_items=64, max_mb=512):
+        self.max_items = max_items
+        self.max_bytes = max_mb * 2 ** 20
+        self.hits = self.misses = self.evictions = 0
+        self.nbytes = 0
+        self._figures = OrderedDict()  # key: (figure, estimated bytes)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(name, gene, plot_fn, args):
+        style = (PLOT_SIZE, matplotlib.rcParams['figure.dpi'])
+        return name, gene, plot_fn.__name__, args, style
+
+    @staticmethod
+    def figure_bytes(fig):
+        """rough size of a figure: its rgba render buffer"""
+        width, height = fig.get_size_inches() * fig.dpi
+        return int(width * height * 4)
+
+    def __contains__(self, key):
+        return key in self._figures  # no hit / miss accounting, for prefetching
+
+    def get(self, key):
+        with self._lock:
+            entry = self._figures.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._figures.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, fig):
+        size = self.figure_bytes(fig)
+        with self._lock:
+            if key in self._figures:
+                self.nbytes -= self._figures.pop(key)[1]
+            self._figures[key] = (fig, size)
+            self.nbytes += size
+            while self._figures and (len(self._figures) > self.max_items or self.nbytes > self.max_bytes):
+                _, (_, evicted_size) = self._figures.popitem(last=False)  # figures are not pyplot-managed, dropping frees them
+                self.nbytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._figures.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "figures": len(self._figures), "mb": round(self.nbytes / 2 ** 20, 1)}
+
+
+FIGURE_CACHE = FigureCache()
+IMAGE_CACHE_DIR = 'renders'  # inside the datasets' cache folder
+
+
+def image_cache(path=r'datasets', max_mb=256):
+    """on-disk cache of rendered plots (cache.ImageCache), shared by every process that shows the datasets in path"""
+    return cache.ImageCache(f'{path}/{cache.CACHE_DIR}/{IMAGE_CACHE_DIR}', max_mb)
+
+
+def image_key(name, plot_fn, args, gene, path=r'datasets'):
+    """everything a rendered plot depends on: the dataset csv (mtime, size), the plot, the gene and the style"""
+    source = cache.source_key(f'{path}/{DATASETS[name].file}')
+    return [name, [source["mtime"], source["size"]], plot_fn.__name__, list(args), gene,
+            PLOT_SIZE, matplotlib.rcParams['figure.dpi']]
+
+
+def image_figure(png):
+    """a figure that shows a png rendered earlier. its bytes are kept in fig.png, for saving without re-encoding"""
+    fig = Figure(figsize=PLOT_SIZE)
+    FigureCanvasAgg(fig)
+    ax = fig.add_axes((0, 0, 1, 1))
+    ax.imshow(matplotlib.image.imread(io.BytesIO(png), format='png'), aspect='auto', interpolation='antialiased')
+    ax.axis('off')
+    fig.png = png
+    return fig
+
+
+class ImageSaver:
+    """encodes freshly rendered figures into image caches on a daemon thread, off the path that shows them.
+    a figure is pickled when it is queued (a few ms, a png encode takes ~100) and the thread encodes that copy,
+    so the figure on screen is never touched from here. pause while the user waits on a foreground query"""
+
+    def __init__(self):
+        self._saves = deque()
+        self._cond = threading.Condition()
+        self._running = threading.Event()
+        self._running.set()
+        self._idle = threading.Event()
+        self._idle.set()
+        self._thread = None
+
+    def save(self, image_cache, key, name, fig):
+        self.save_pickled(image_cache, key, name, pickle.dumps(fig))
+
+    def save_pickled(self, image_cache, key, name, snapshot):
+        """queues a figure that is already pickled, e.g. the one a render worker sent back"""
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="image-save", daemon=True)
+                self._thread.start()
+            self._saves.append((image_cache, key, name, snapshot))
+            self._idle.clear()
+            self._cond.notify()
+
+    def pause(self):
+        self._running.clear()
+
+    def resume(self):
+        self._running.set()
+
+    @property
+    def pending(self):
+        return len(self._saves)
+
+    def wait(self, timeout=None):
+        """waits until every queued figure is saved (resume first if paused). returns False on timeout"""
+        return self._idle.wait(timeout)
+
+    def stop(self, timeout=None):
+        """drops the queued figures and waits for the one being encoded, before exiting"""
+        with self._cond:
+            self._saves.clear()
+        self.resume()
+        return self.wait(timeout)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._saves:
+                    self._idle.set()
+                    self._cond.wait()
+            self._running.wait()
+            with self._cond:
+                if not self._saves:  # dropped by stop
+                    continue
+                image_cache, key, name, snapshot = self._saves.popleft()
+            try:
+                with TIMINGS.timed("save", name):
+                    png = figure_bytes(pickle.loads(snapshot))
+                image_cache.put(key, png)
+            except Exception as e:
+                print(f"saving the plot of {name} failed: {e}")
+
+
+IMAGE_SAVER = ImageSaver()
+
+
+def save_image(image_cache, name, plot_fn, args, gene, fig):
+    """queues the png of a freshly rendered figure for image_cache on IMAGE_SAVER, the caller can show it right away"""
+    if image_cache is None or fig is None or getattr(fig, 'png', None) is not None:
+        return
+    IMAGE_SAVER.save(image_cache, image_key(name, plot_fn, args, gene), name, fig)
+
 
+def figure_bytes(fig, fmt='png'):
+    """the figure encoded as fmt (png, svg, pdf)"""
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format=fmt)
+    return buffer.getvalue()
 
-def import_datasets(path=r'datasets'):
-    datasets = {}
-
-    ts_pancreas = pd.read_csv(f'{path}/TabulaSapiens_pancreas.csv')
-    datasets["ts_pancreas"] = ts_pancreas
-    ts_liver = pd.read_csv(f'{path}/TabulaSapiens_liver.csv')
-    datasets["ts_liver"] = ts_liver
-    ts_intestine = pd.read_csv(f'{path}/TabulaSapiens_intestine.csv')
-    datasets["ts_intestine"] = ts_intestine
-
-    tm_pancreas = pd.read_csv(f'{path}/tabulamuris_facs_pancreas.csv')
-    tm_pancreas = pd.melt(tm_pancreas, id_vars=['gene'], var_name='celltype', value_name='expression')
-    datasets["tm_pancreas"] = tm_pancreas
-
-    hpa = pd.read_csv(f'{path}/human_protein_atlas_expression.csv')
-    datasets["hpa"] = hpa
-
-    yotams_visium_zonation = pd.read_csv(f'{path}/yotams_visium_zonation.csv')
-    yotams_visium_zonation = pd.melt(yotams_visium_zonation, id_vars=['gene'], var_name='zone', value_name='expression')
-    datasets["yotams_visium_zonation"] = yotams_visium_zonation
-
-    rachel_zwick_human = pd.read_csv(f'{path}/rachel_zwick_human.csv')
-    rachel_zwick_human = pd.melt(rachel_zwick_human, id_vars=['gene', 'section'], var_name='celltype', value_name='expression')
-    datasets["rachel_zwick_human"] = rachel_zwick_human
-
-    rachel_zwick_mouse = pd.read_csv(f'{path}/rachel_zwick_mouse.csv')
-    rachel_zwick_mouse = pd.melt(rachel_zwick_mouse, id_vars=['gene', 'section'], var_name='celltype', value_name='expression')
-    datasets["rachel_zwick_mouse"] = rachel_zwick_mouse
-
-    innas = pd.read_csv(f'{path}/mouse_intestines_sc_innas.csv')
-    innas = pd.melt(innas, id_vars=['gene'], var_name='celltype', value_name='expression')
-    datasets["innas"] = innas
-
-    yotams_sc_sigmat = pd.read_csv(f'{path}/human_intestines_sc.csv')
-    yotams_sc_sigmat = pd.melt(yotams_sc_sigmat, id_vars=['gene'], var_name='celltype', value_name='expression')
-    datasets["yotams_sc_sigmat"] = yotams_sc_sigmat
-
-    apap = pd.read_csv(f'{path}/liver_from_APAP.csv')
-    apap = pd.melt(apap, id_vars=['gene'], var_name='celltype', value_name='expression')
-    datasets["apap"] = apap
-
-    human_apicome = pd.read_csv(f'{path}/human_apicome.csv')
-    human_apicome = pd.melt(human_apicome, id_vars=['gene'], var_name='apicome', value_name='expression')
-    datasets["human_apicome"] = human_apicome
-
-    mouse_apicome = pd.read_csv(f'{path}/mouse_apicome.csv')
-    mouse_apicome = pd.melt(mouse_apicome, id_vars=['gene'], var_name='apicome', value_name='expression')
-    datasets["mouse_apicome"] = mouse_apicome
-
-    thyroid_kang = pd.read_csv(f'{path}/thyroid_sig_mat.csv')
-    thyroid_kang = pd.melt(thyroid_kang, id_vars=['gene'], var_name='celltype', value_name='expression')
-    datasets["thyroid_Kang"] = thyroid_kang
 
-    return datasets
+def cached_image(image_cache, name, plot_fn, args, gene):
+    """image_figure of the plot if image_cache has it, else None. needs no dataset"""
+    if image_cache is None:
+        return None
+    png = image_cache.get(image_key(name, plot_fn, args, gene))
+    return None if png is None else image_figure(png)
 
 
-def make_plots(organism, organ, gene, datasets):
-    """returns list of plots"""
+def job_args(spec):
+    """extra args of the plot function of a dataset's plot kind"""
+    if spec.kind in ("bar", "hpa"):
+        return spec.title, spec.var_name, spec.value_name
+    if spec.kind == "sections":
+        return spec.title, spec.var_name, spec.value_name, spec.id_vars[1]
+    return (spec.title,)
+
+
+def plot_jobs(organism, organ):
+    """returns the plots for organism and organ as [(dataset name, plot function, extra args)], in registry order"""
+    return [(name, PLOT_KINDS[spec.kind], job_args(spec)) for name, spec in DATASETS.items()
+            if spec.organism == organism and spec.organ == organ]
+
+
+def holding_jobs(jobs, gene, presence):
+    """the jobs whose dataset holds gene according to the presence bitmap of a SymbolIndex, without loading any dataset"""
+    if presence is None or isinstance(gene, tuple):
+        return jobs
+    return [job for job in jobs if presence.has(gene, job[0])]
+
+
+def panel_jobs(organism, organ):
+    """like plot_jobs, with a genes x celltypes heatmap per dataset. their gene argument is a tuple of genes"""
+    return [(name, PLOT_KINDS["heatmap"], (DATASETS[name].title,)) for name, _, _ in plot_jobs(organism, organ)]
+
+
+def compare_jobs():
+    """the job of the all-datasets comparison. its plot function takes all the datasets instead of one table"""
+    return [(COMPARE_NAME, compare_datasets, ())]
+
+
+def table_gene(table, gene):
+    """the table's spelling of gene, matched case-insensitively like the symbol index (e.g. mouse Gapdh for GAPDH),
+    or None. for a tuple of genes (panel plots) the tuple of the ones the table has, None if it has none"""
+    if isinstance(gene, tuple):
+        return tuple(found for found in map(table.find, gene) if found is not None) or None
+    return table.find(gene)
+
+
+def has_gene(table, gene):
+    """index lookup, see table_gene"""
+    return table_gene(table, gene) is not None
+
+
+def render(name, plot_fn, args, gene, datasets, figure_cache=FIGURE_CACHE, image_cache=None):
+    """returns the figure of one plot job, from figure_cache if it was rendered before, else from image_cache
+    (the saved png, without loading the dataset). None if the gene is missing.
+    the figure build is timed per dataset, including its lookup and tight_layout"""
+    key = None if figure_cache is None else figure_cache.key(name, gene, plot_fn, args)
+    fig = None if key is None else figure_cache.get(key)  # one call: another thread may evict the key meanwhile
+    if fig is not None:
+        return fig
+    fig = cached_image(image_cache, name, plot_fn, args, gene)
+    if fig is not None:
+        if key is not None:
+            figure_cache.put(key, fig)
+        return fig
+    table = datasets[name]
+    found = table_gene(table, gene)  # index lookup, no figure build for a missing gene
+    if found is None:
+        return None
+    with TIMINGS.timed("figure", name):
+        fig = plot_fn(table, found, *args)
+    if fig is not None:
+        save_image(image_cache, name, plot_fn, args, gene, fig)
+        if key is not None:
+            figure_cache.put(key, fig)
+    return fig
+
+
+RENDER_POOL = None
+_worker_datasets = None
+
+
+def render_pool(path=r'datasets', workers=None):
+    """process pool for rendering plots in parallel, created on first use. every worker keeps its own
+    lazily loaded, memory mapped datasets (one page-cache copy for all of them)"""
+    global RENDER_POOL
+    if RENDER_POOL is None:
+        # spawn, not fork: the app forks from a process that already runs Tk and threads
+        RENDER_POOL = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'),
+                                          initializer=_init_render_worker, initargs=(path,))
+    return RENDER_POOL
+
+
+def _init_render_worker(path):
+    global _worker_datasets
+    use_manifest(path)
+    _worker_datasets = lazy_datasets(path, mmap=True)
+
+
+def _render_in_worker(name, plot_fn, args, gene):
+    table = _worker_datasets[name]
+    found = table_gene(table, gene)
+    fig = None if found is None else plot_fn(table, found, *args)
+    # pickled here, not by the pool: the same bytes are the figure for the caller and the snapshot for the image saver
+    return None if fig is None else pickle.dumps(fig)
+
+
+def submit_render(pool, name, plot_fn, args, gene, figure_cache=FIGURE_CACHE, image_cache=None):
+    """like render, but runs the plot function in a worker of pool. returns a Future of the figure (None if the gene is missing).
+    a freshly rendered figure is queued for image_cache from its pickle, before it is cached or handed to anyone"""
+    key = None if figure_cache is None else figure_cache.key(name, gene, plot_fn, args)
+    fig = None if key is None else figure_cache.get(key)
+    if fig is None:
+        fig = cached_image(image_cache, name, plot_fn, args, gene)
+    if fig is not None:
+        future = Future()
+        future.set_result(fig)
+        return future
+    future = Future()
+
+    def _unpickle_result(done):
+        if done.cancelled():
+            future.cancel()
+            return
+        try:
+            snapshot = done.result()
+            fig = None if snapshot is None else pickle.loads(snapshot)
+            if fig is not None:
+                if image_cache is not None:
+                    IMAGE_SAVER.save_pickled(image_cache, image_key(name, plot_fn, args, gene), name, snapshot)
+                if key is not None:
+                    figure_cache.put(key, fig)
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            future.set_result(fig)
+    pool.submit(_render_in_worker, name, plot_fn, args, gene).add_done_callback(_unpickle_result)
+    return future
+
+
+def _render_bytes_in_worker(name, plot_fn, args, gene, fmt):
+    table = _worker_datasets[name]
+    found = table_gene(table, gene)
+    fig = None if found is None else plot_fn(table, found, *args)
+    return None if fig is None else figure_bytes(fig, fmt)
+
+
+def submit_render_bytes(pool, name, plot_fn, args, gene, fmt='png'):
+    """like submit_render without the caches, but the worker encodes the figure and sends back only its bytes,
+    a fraction of a pickled figure. returns a Future of the bytes (None if the gene is missing)"""
+    return pool.submit(_render_bytes_in_worker, name, plot_fn, args, gene, fmt)
+
+
+def make_plots(organism, organ, gene, datasets, figure_cache=FIGURE_CACHE, pool=None, presence=None, image_cache=None):
+    """returns list of plots. with a pool (see render_pool) the plots are rendered in parallel worker processes,
+    datasets is then only used to skip the ones that lack the gene when there is no presence, and may be None.
+    with presence (a SymbolIndex) datasets that lack the gene are skipped before anything is loaded or dispatched.
+    with an image_cache (see image_cache) plots rendered before, also by another run, are read from disk"""
+    jobs = holding_jobs(plot_jobs(organism, organ), gene, presence)
+    if pool is None:
+        figs = [render(name, plot_fn, args, gene, datasets, figure_cache, image_cache) for name, plot_fn, args in jobs]
+    else:
+        if datasets is not None and presence is None:
+            jobs = [job for job in jobs if has_gene(datasets[job[0]], gene)]
+        futures = [submit_render(pool, name, plot_fn, args, gene, figure_cache, image_cache) for name, plot_fn, args in jobs]
+        figs = [future.result() for future in futures]
     plots, names = [], []
-    if organ == "all tissues":
-        if organism == "human":
-            plots.append(hpa(datasets['hpa'], gene))
-            names += ['hpa']
-        elif organism == "mouse":
-            pass
-    if organ == "intestine":
-        if organism == "human":
-            plots.append(tabula_sapiens(datasets['ts_intestine'], gene, organ))
-            plots.append(yotams_sc(datasets['yotams_sc_sigmat'], gene))
-            plots.append(yotams_visium(datasets['yotams_visium_zonation'], gene))
-            names += ['ts_intestine', 'yotams_sc_sigmat', 'yotams_visium_zonation']
-        elif organism == "mouse":
-            plots.append(inna(datasets['innas'], gene))
-            names += ['innas']
-        plots.append(apicome(datasets[f'{organism}_apicome'], gene, organism))
-        plots.append(rachel_zwick(datasets[f'rachel_zwick_{organism}'], gene, organism))
-        names += [f'{organism}_apicome', f'rachel_zwick_{organism}']
-    if organ == "pancreas":
-        if organism == "human":
-            plots.append(tabula_sapiens(datasets['ts_pancreas'], gene, organ))
-            names += ['ts_pancreas']
-        elif organism == "mouse":
-            plots.append(tabula_muris(datasets['tm_pancreas'], gene, organ))
-            names += ['tm_pancreas']
-    if organ == "liver":
-        if organism == "human":
-            plots.append(tabula_sapiens(datasets['ts_liver'], gene, organ))
-            names += ['ts_liver']
-        elif organism == "mouse":
-            plots.append(shani(datasets['apap'], gene))
-            names += ['apap']
-    if organ == "thyroid" and organism == "human":
-        plots.append(plot_thyroid(datasets['thyroid_Kang'], gene))
-        names += ['thyroid_Kang']
-
-    names = [names[i] for i in range(len(plots)) if plots[i] is not None]
-    plots = [plot for plot in plots if plot is not None]
+    for (name, _, _), fig in zip(jobs, figs):
+        if fig is not None:
+            plots.append(fig)
+            names.append(name)
     return plots, names
 
 
-def bar(df, gene, title, x="celltype", y="expression", organism=''):
-    if gene not in df['gene'].values:
-        return
-    gene_df = df[df['gene'] == gene]
-    plt.figure(figsize=PLOT_SIZE)
-    print(gene_df.head())
-    ax = sns.barplot(data=gene_df, x=x, y=y, color='blue', edgecolor='black')
-    ax.set_xticklabels(ax.get_xticklabels(), rotation=45, horizontalalignment='right')
-    plt.xlabel('')
-    plt.ylabel('Expression')
-    plt.title(f'{organism}{title} - {gene}')
-    plt.tight_layout()
-    return plt.gcf()
-
-
-def shani(df, gene):
-    return bar(df, gene, "Liver atlas (2020)")
-
-
-def yotams_visium(df, gene):
-    return bar(df, gene, "Yotams visium", x="zone")
-
-
-def apicome(df, gene, organism):
-    return bar(df, gene, " Intestines (Yotams visium)", x="apicome", organism=organism)
+class Prefetcher:
+    """renders queries ahead of time into a figure cache, on a daemon thread that yields to foreground rendering.
+    with a pool (see render_pool) the plots are rendered by its workers and no dataset is loaded here"""
+
+    def __init__(self, datasets, figure_cache=FIGURE_CACHE, image_cache=None, pool=None):
+        self.datasets = datasets
+        self.figure_cache = figure_cache
+        self.image_cache = image_cache
+        self.pool = pool
+        self._queries = deque()
+        self._cond = threading.Condition()
+        self._running = threading.Event()
+        self._running.set()
+        self._thread = threading.Thread(target=self._run, name="prefetch", daemon=True)
+        self._thread.start()
+
+    def prefetch(self, organism, organ, genes):
+        """replaces the queued queries with genes, in order of priority"""
+        with self._cond:
+            self._queries.clear()
+            for gene in dict.fromkeys(genes):
+                if gene:
+                    self._queries.append((organism, organ, gene))
+            self._cond.notify()
+
+    def pause(self):
+        """stops between two plots until resume, while the user waits on a foreground query"""
+        self._running.clear()
+
+    def resume(self):
+        self._running.set()
+
+    @property
+    def pending(self):
+        return len(self._queries)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queries:
+                    self._cond.wait()
+                organism, organ, gene = self._queries.popleft()
+            for name, plot_fn, args in plot_jobs(organism, organ):
+                self._running.wait()
+                if self.figure_cache.key(name, gene, plot_fn, args) in self.figure_cache:
+                    continue
+                try:
+                    if self.pool is None:
+                        render(name, plot_fn, args, gene, self.datasets, self.figure_cache, self.image_cache)
+                    else:
+                        submit_render(self.pool, name, plot_fn, args, gene, self.figure_cache, self.image_cache).result()
+                except Exception as e:
+                    print(f"prefetch of {name} {gene} failed: {e}")
+
+
+_reused = threading.local()
+
+
+def new_figure():
+    """a figure with its own Agg canvas that is not registered with pyplot,
+    so it is freed as soon as nothing references it and can be drawn off the Tk thread"""
+    fig = getattr(_reused, 'fig', None)
+    if fig is None:
+        fig = Figure(figsize=PLOT_SIZE)
+        FigureCanvasAgg(fig)
+    else:
+        fig.clf()
+        _reused.bar_template = None
+    return fig, fig.subplots()
+
+
+def reuse_figure(enabled=True):
+    """makes new_figure hand out one cleared figure per thread instead of allocating one per plot (batch rendering).
+    a figure returned earlier in this thread is overwritten by the next plot, so save it before plotting again"""
+    _reused.fig = None
+    _reused.bar_template = None
+    if enabled:
+        _reused.fig = new_figure()[0]
+
+
+def gene_rows(df, gene):
+    with TIMINGS.timed("lookup"):
+        return df.get(gene)
+
+
+def tight_layout(fig):
+    with TIMINGS.timed("tight_layout"):
+        fig.tight_layout()
+
+
+def fast_bar(labels, values, title):
+    """bar plot of one value per label with plain matplotlib, pixel-equivalent to the sns.barplot of bar.
+    on a reused figure (see reuse_figure) the axes stay as a template: when the labels are the same as in the
+    previous plot only the bar heights, y limits and title change"""
+    template = getattr(_reused, 'bar_template', None)
+    if template is not None and np.array_equal(template[0], labels):
+        _, fig, ax, bars = template
+        for patch, value in zip(bars, values):
+            patch.set_height(value)
+        ax.relim()
+        ax.autoscale_view()
+    else:
+        fig, ax = new_figure()
+        positions = np.arange(len(values))
+        bars = ax.bar(positions, values, width=.8, color=BAR_COLOR, edgecolor='black')
+        ax.set_xlim(-.5, len(values) - .5)
+        ax.set_xticks(positions, labels, rotation=45, horizontalalignment='right')
+        ax.set_ylabel('Expression')
+        if fig is getattr(_reused, 'fig', None):
+            _reused.bar_template = (np.array(labels), fig, ax, bars)
+    ax.set_title(title)
+    tight_layout(fig)
+    return fig
 
 
-def inna(df, gene):
-    return bar(df, gene, "mouse intestine")
-
-
-def hpa(df, gene):
-    if gene not in df['gene'].values:
-        return
-    gene_df = df[df['gene'] == gene]
-    plt.figure(figsize=PLOT_SIZE)
-    gene_df = gene_df.sort_values('organ')
-    ax = sns.barplot(data=gene_df, x='tissue', y='nTPM', hue='organ', edgecolor='black', dodge=False)
-    ax.set_xticklabels(ax.get_xticklabels(), rotation=45, horizontalalignment='right')
-    plt.xlabel('')
-    plt.ylabel('nTPM')
-    plt.title(f'human protein atlas - {gene}')
-    plt.tight_layout()
-    plt.legend([], [], frameon=False)
-    return plt.gcf()
-
-
-def tabula_muris(df, gene, organ="pancreas"):
-    if gene not in df['gene'].values:
+def bar(df, gene, title, x="celltype", y="expression", organism=''):
+    title = f'{organism}{title} - {gene}'
+    if isinstance(df, WideTable) and not df.ids and x == df.var_name:  # the matrix row, no long frame
+        with TIMINGS.timed("lookup"):
+            rows = df.rows(gene)
+        if rows is None:
+            return
+        if len(rows) == 1:
+            return fast_bar(df.columns, rows[0], title)
+    gene_df = gene_rows(df, gene)
+    if gene_df is None:
         return
-    gene_df = df[df['gene'] == gene]
-    plt.figure(figsize=PLOT_SIZE)
-    ax = sns.barplot(data=gene_df, x='celltype', y='expression', color='blue', edgecolor='black')
+    if gene_df[x].is_unique and not pd.api.types.is_numeric_dtype(gene_df[x]):
+        return fast_bar(gene_df[x].to_numpy(), gene_df[y].to_numpy(), title)
+    # several values per label: seaborn's mean and confidence interval
+    fig, ax = new_figure()
+    sns.barplot(data=gene_df, x=x, y=y, color='blue', edgecolor='black', ax=ax)
     ax.set_xticklabels(ax.get_xticklabels(), rotation=45, horizontalalignment='right')
-    plt.xlabel('')
-    plt.ylabel('Expression')
-    plt.title(f'mouse {organ} (Tabula Muris) - {gene}')
-    plt.tight_layout()
-    return plt.gcf()
+    ax.set_xlabel('')
+    ax.set_ylabel('Expression')
+    ax.set_title(title)
+    tight_layout(fig)
+    return fig
 
 
-def tabula_sapiens(df, gene, organ):
-    if gene not in df['gene'].values:
+def hpa(df, gene, title='human protein atlas', x='tissue', y='nTPM', hue='organ'):
+    """bar per x, colored by the hue column (the dataset needs an organ column)"""
+    gene_df = gene_rows(df, gene)
+    if gene_df is None:
         return
-    gene_df = df[df['gene'] == gene]
-    plt.figure(figsize=PLOT_SIZE)
-    ax = sns.barplot(data=gene_df, x='celltype', y='expression', color='blue', edgecolor='black')
+    fig, ax = new_figure()
+    gene_df = gene_df.sort_values(hue)
+    sns.barplot(data=gene_df, x=x, y=y, hue=hue, edgecolor='black', dodge=False, ax=ax)
     ax.set_xticklabels(ax.get_xticklabels(), rotation=45, horizontalalignment='right')
-    plt.xlabel('')
-    plt.ylabel('Expression')
-    plt.title(f'human {organ} (Tabula Sapiens) - {gene}')
-    plt.tight_layout()
-    return plt.gcf()
-
-
-def yotams_sc(df, gene):
-    return bar(df, gene, "Human intestines (single cell)")
-
-
-def rachel_zwick(df, gene, organism):
-    if gene not in df['gene'].values:
+    ax.set_xlabel('')
+    ax.set_ylabel(y)
+    ax.set_title(f'{title} - {gene}')
+    tight_layout(fig)
+    ax.legend([], [], frameon=False)
+    return fig
+
+
+def sections(df, gene, title, hue='celltype', y='expression', x='section'):
+    """expression along the intestine sections (the x id column), a line per celltype (hue)"""
+    gene_df = gene_rows(df, gene)
+    if gene_df is None:
         return
-    gene_df = df[df['gene'] == gene]
-    plt.figure(figsize=PLOT_SIZE)
-    ax = sns.lineplot(data=gene_df, x="section", y="expression", hue="celltype")
-    ax.set_xticks(gene_df["section"].unique())
-    labels = ['' for _ in range(len(gene_df["section"].unique()))]
+    fig, ax = new_figure()
+    sns.lineplot(data=gene_df, x=x, y=y, hue=hue, ax=ax)
+    ax.set_xticks(gene_df[x].unique())
+    labels = ['' for _ in range(len(gene_df[x].unique()))]
     labels[0], labels[-1] = 'Duodenum', "terminal ileum"
     ax.set_xticklabels(labels)
-    plt.xlabel('')
-    plt.ylabel('Expression')
-    plt.title(f'{organism} intestine sectiones - {gene}')
-    plt.tight_layout()
-    plt.legend(loc='upper right')
-    return plt.gcf()
-
-
-def plot_thyroid(df, gene):
-    return bar(df, gene, "Human thyroid (Keng et al.)")
-
-
-# x = import_datasets()
-# gene = "RPS14"
-
-# df = x["rachel_zwick_human"]
-# fig = rachel_zwick(df, gene, "human")
-# df = x["rachel_zwick_mouse"]
-# fig = rachel_zwick(df, gene, "mouse")
-# df = x["yotams_visium_zonation"]
-# fig = yotams_visium(df, gene)
-# df = x["shani_zonation"]
-# fig = shani(df, gene)
-# df = x["mouse_apicome"]
-# fig = apicome(df, gene, "mouse")
-# df = x["innas"]
-# fig = inna(df, gene)
-# df = x["hpa"]
-# fig = hpa(df, gene)
-# df = x["tm_pancreas"]
-# fig = tabula_muris(df, gene, "pancreas")
-# df = x["ts_pancreas"]
-# fig = tabula_sapiens(df, gene, "pancreas")
-# df = x["ts_intestine"]
-# fig = tabula_sapiens(df, gene, "intestine")
-# df = x["ts_liver"]
-# fig = tabula_sapiens(df, gene, "liver")
-# df = x["yotams_sc_sigmat"]
-# fig = yotams_sc(df, gene)
-
-# fig.show()
+    ax.set_xlabel('')
+    ax.set_ylabel('Expression')
+    ax.set_title(f'{title} - {gene}')
+    tight_layout(fig)
+    ax.legend(loc='upper right')
+    return fig
+
+
+def heatmap(df, genes, title, scale=True):
+    """genes x celltypes heatmap for a panel of genes (a tuple), with every gene scaled to its maximum when scale.
+    as the plot kind of a dataset it is called with one gene"""
+    single = isinstance(genes, str)
+    with TIMINGS.timed("lookup"):
+        matrix = df.matrix([genes] if single else genes)
+    if matrix.empty:
+        return
+    values = np.nan_to_num(matrix.to_numpy(dtype=float))
+    if scale:
+        peak = values.max(axis=1, keepdims=True)
+        values = np.divide(values, peak, out=np.zeros_like(values), where=peak > 0)
+    fig, ax = new_figure()
+    image = ax.imshow(values, aspect='auto', cmap='viridis', interpolation='nearest')
+    ax.set_xticks(range(values.shape[1]), [str(col) for col in matrix.columns], rotation=45, horizontalalignment='right')
+    if len(matrix) <= HEATMAP_MAX_LABELS:
+        ax.set_yticks(range(len(matrix)), matrix.index, fontsize=max(4, min(10, 400 // len(matrix))))
+    else:
+        ax.set_yticks([])
+    fig.colorbar(image, ax=ax, label='Relative expression' if scale else 'Expression')
+    ax.set_title(f'{title} - {genes if single else f"{len(matrix)} genes"}')
+    tight_layout(fig)
+    return fig
+
+
+PLOT_KINDS = {"bar": bar, "hpa": hpa, "sections": sections, "heatmap": heatmap}  # plot kind of a dataset: plot function
+
+
+def gene_profiles(datasets, gene, names=None, presence=None):
+    """[(name, labels, values relative to the dataset's scale)] of gene in every dataset that holds it (names: all),
+    one value per celltype (averaged over sections and organs), the most expressing dataset first.
+    with presence (a SymbolIndex) datasets that lack the gene are skipped without being loaded"""
+    names = list(DATASETS) if names is None else names
+    profiles = []
+    with TIMINGS.timed("lookup", COMPARE_NAME):
+        for name in names:
+            if presence is not None and not presence.has(gene, name):
+                continue
+            table = datasets[name]
+            found = table.find(gene)
+            if found is None:
+                continue
+            row = table.matrix([found])  # one gene index lookup, rows already averaged per celltype
+            scale = table.scale()
+            values = row.to_numpy(dtype=float)[0] / (scale if scale > 0 else 1)
+            profiles.append((name, np.array([str(col) for col in row.columns]), np.nan_to_num(values)))
+    profiles.sort(key=lambda profile: -profile[2].max(initial=0))
+    return profiles
+
+
+def compare_datasets(datasets, gene, names=None, presence=None):
+    """small multiples of gene in every dataset that holds it, each scaled to its dataset's 99th percentile
+    (the dotted line), so 1 means as high as the dataset's top expressed genes. each panel names its highest celltype.
+    the panels share one axes and their bars one collection, dozens of real subplots take a second to draw"""
+    with TIMINGS.timed("figure", COMPARE_NAME):
+        profiles = gene_profiles(datasets, gene, names, presence)
+        if not profiles:
+            return
+        fig, ax = new_figure()
+        n_rows = -(-len(profiles) // COMPARE_COLUMNS)
+        boxes, bars, lines = [], [], []
+        for i, (name, labels, values) in enumerate(profiles):
+            # panel i spans x0..x0+1 and y0..y0+1, its values are scaled to ymax
+            x0, y0 = (i % COMPARE_COLUMNS) * 1.25, (n_rows - 1 - i // COMPARE_COLUMNS) * 1.6
+            ymax = max(1, values.max()) * 1.05
+            left = x0 + (np.arange(len(values)) + .1) / len(values)
+            top = y0 + values / ymax
+            right = left + .8 / len(values)
+            bars.append(np.stack([np.c_[left, np.full_like(left, y0)], np.c_[left, top], np.c_[right, top],
+                                  np.c_[right, np.full_like(left, y0)]], axis=1))
+            boxes.append([(x0, y0), (x0, y0 + 1), (x0 + 1, y0 + 1), (x0 + 1, y0), (x0, y0)])
+            lines.append([(x0, y0 + 1 / ymax), (x0 + 1, y0 + 1 / ymax)])
+            ax.text(x0 + .5, y0 + 1.08, DATASETS[name].label, ha='center', va='bottom', fontsize=7)
+            ax.text(x0 + .5, y0 - .06, f'top: {labels[values.argmax()]}', ha='center', va='top', fontsize=6)
+            ax.text(x0 - .03, y0 + 1, f'{ymax:.2g}', ha='right', va='top', fontsize=5)
+        ax.add_collection(PolyCollection(np.concatenate(bars), facecolors=BAR_COLOR, edgecolors='none'))
+        ax.add_collection(LineCollection(boxes, colors='black', linewidths=.6))
+        ax.add_collection(LineCollection(lines, colors='grey', linestyles=':', linewidths=.8))
+        ax.set_xlim(-.15, COMPARE_COLUMNS * 1.25 - .2)
+        ax.set_ylim(-.3, n_rows * 1.6 - .2)
+        ax.axis('off')
+        ax.set_title(f"{gene} in {len(profiles)} datasets - relative to each dataset's 99th percentile", fontsize=10)
+        fig.subplots_adjust(left=.02, right=.98, bottom=.02, top=.93)  # one axes, no tight_layout needed
+    return fig
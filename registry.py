@@ -0,0 +1,284 @@
+import os
+import time
+import threading
+import multiprocessing
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, CancelledError
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+import pandas as pd
+from store import GeneTable, WideTable, DatasetRegistry, compact_frame
+import cache
+from timing import TIMINGS
+
+# one registry of datasets for both front ends: the built-in datasets below, merged with datasets/manifest.csv.
+# a manifest row with the file of a built-in dataset overrides its fields, any other row adds a dataset
+
+MANIFEST_FILE = 'manifest.csv'
+LAYOUTS = ["wide", "long"]  # wide: gene x celltype matrix, long: one row per gene and celltype
+PLOT_KINDS = ["bar", "hpa", "sections", "heatmap"]  # see plot.PLOT_KINDS
+# eager: loaded by the warm-up at startup, cached: loaded from the binary cache on first use,
+# mmap: binary cache memory mapped on first use (big wide atlases, streamed into the cache chunk by chunk
+# and never held in memory), lazy: parsed from the csv on first use, no binary cache
+LOAD_POLICIES = ["eager", "cached", "mmap", "lazy"]
+STREAM_CHUNK_ROWS = 50_000  # csv rows in memory at once while streaming an mmap dataset into its cache
+PARSE_PROCESS_MB = 20  # smaller csvs are parsed by the warm-up thread itself, starting a process costs more
+KILL_WAIT = 1  # seconds cancel waits for each killed parse process, before removing its scratch files
+
+DatasetSpec = namedtuple('DatasetSpec', ['name', 'file', 'organism', 'organ', 'layout', 'id_vars', 'var_name', 'value_name',
+                                         'kind', 'title', 'load', 'label', 'paper_url'],
+                         defaults=('wide', ('gene',), 'celltype', 'expression', 'bar', '', 'cached', '', ''))
+
+
+def _spec(name, file, organism, organ, title, layout='wide', id_vars=('gene',), var_name='celltype', value_name='expression',
+          kind='bar', load='eager'):
+    return DatasetSpec(name, file, organism, organ, layout, id_vars, var_name, value_name, kind, title, load, title)
+
+
+# in plot order within an organism and organ
+BUILTIN_DATASETS = [
+    _spec("hpa", 'human_protein_atlas_expression.csv', "human", "all tissues", "human protein atlas",
+          layout='long', var_name='tissue', value_name='nTPM', kind='hpa'),
+    _spec("ts_intestine", 'TabulaSapiens_intestine.csv', "human", "intestine", "human intestine (Tabula Sapiens)", layout='long'),
+    _spec("yotams_sc_sigmat", 'human_intestines_sc.csv', "human", "intestine", "Human intestines (single cell)"),
+    _spec("yotams_visium_zonation", 'yotams_visium_zonation.csv', "human", "intestine", "Yotams visium", var_name='zone'),
+    _spec("innas", 'mouse_intestines_sc_innas.csv', "mouse", "intestine", "mouse intestine"),
+    _spec("human_apicome", 'human_apicome.csv', "human", "intestine", "human Intestines (Yotams visium)", var_name='apicome'),
+    _spec("mouse_apicome", 'mouse_apicome.csv', "mouse", "intestine", "mouse Intestines (Yotams visium)", var_name='apicome'),
+    _spec("rachel_zwick_human", 'rachel_zwick_human.csv', "human", "intestine", "human intestine sectiones",
+          id_vars=('gene', 'section'), kind='sections'),
+    _spec("rachel_zwick_mouse", 'rachel_zwick_mouse.csv', "mouse", "intestine", "mouse intestine sectiones",
+          id_vars=('gene', 'section'), kind='sections'),
+    _spec("ts_pancreas", 'TabulaSapiens_pancreas.csv', "human", "pancreas", "human pancreas (Tabula Sapiens)", layout='long'),
+    _spec("tm_pancreas", 'tabulamuris_facs_pancreas.csv', "mouse", "pancreas", "mouse pancreas (Tabula Muris)"),
+    _spec("ts_liver", 'TabulaSapiens_liver.csv', "human", "liver", "human liver (Tabula Sapiens)", layout='long'),
+    _spec("apap", 'liver_from_APAP.csv', "mouse", "liver", "Liver atlas (2020)"),
+    _spec("thyroid_Kang", 'thyroid_sig_mat.csv', "human", "thyroid", "Human thyroid (Keng et al.)"),
+]
+
+# manifest columns. id_columns are separated by ';'
+MANIFEST_REQUIRED = ["file", "organism", "organ", "dataset_name", "paper_url"]
+MANIFEST_OPTIONAL = ["name", "layout", "id_columns", "var_name", "value_name", "kind", "title", "load"]
+
+
+def read_manifest(file_path):
+    """manifest rows as dicts of DatasetSpec fields, in file order"""
+    mf = pd.read_csv(file_path, dtype=str, keep_default_na=False)
+    missing = set(MANIFEST_REQUIRED) - set(mf.columns)
+    if missing:
+        raise ValueError(f"{MANIFEST_FILE} missing columns: {missing}")
+    for col in MANIFEST_OPTIONAL:
+        if col not in mf.columns:
+            mf[col] = ''
+    specs = []
+    for row in mf.itertuples(index=False):
+        fields = {"file": row.file, "organism": row.organism, "organ": row.organ, "label": row.dataset_name,
+                  "paper_url": row.paper_url, "name": row.name, "layout": row.layout, "var_name": row.var_name,
+                  "value_name": row.value_name, "kind": row.kind, "title": row.title, "load": row.load}
+        if row.id_columns:
+            fields["id_vars"] = tuple(col.strip() for col in row.id_columns.split(';') if col.strip())
+        specs.append({key: value.strip() if isinstance(value, str) else value for key, value in fields.items()})
+    return specs
+
+
+def _check(spec):
+    for field, allowed in (("layout", LAYOUTS), ("kind", PLOT_KINDS), ("load", LOAD_POLICIES)):
+        if getattr(spec, field) not in allowed:
+            raise ValueError(f"dataset {spec.name}: {field} must be one of {', '.join(allowed)}, not {getattr(spec, field)!r}")
+    if spec.kind == "sections" and len(spec.id_vars) < 2:
+        raise ValueError(f"dataset {spec.name}: kind sections needs id_columns gene;section")
+    if spec.layout == "long" and spec.load == "mmap":
+        raise ValueError(f"dataset {spec.name}: load mmap needs a wide layout, long csvs are parsed whole (use cached)")
+    return spec
+
+
+def dataset_specs(path=r'datasets'):
+    """{name: DatasetSpec} of the built-in datasets merged with f'{path}/manifest.csv' (if there is one)"""
+    specs = {spec.name: spec for spec in BUILTIN_DATASETS}
+    manifest = f'{path}/{MANIFEST_FILE}'
+    if not os.path.exists(manifest):
+        return specs
+    by_file = {spec.file: spec.name for spec in BUILTIN_DATASETS}
+    for fields in read_manifest(manifest):
+        fields = {key: value for key, value in fields.items() if value}  # empty cells keep the defaults
+        name = by_file.get(fields["file"])
+        if name is None:
+            name = fields.pop("name", None) or os.path.splitext(fields["file"])[0]
+            fields.setdefault("title", fields.get("label", name))
+            specs[name] = _check(DatasetSpec(name=name, **fields))
+        else:
+            fields.pop("name", None)
+            specs[name] = _check(specs[name]._replace(**fields))
+    for name, spec in specs.items():
+        if not spec.label:
+            specs[name] = spec._replace(label=spec.title or name)
+    return specs
+
+
+def _import_specs(path=r'datasets'):
+    """dataset_specs for the registry at import. a broken manifest is reported in MANIFEST_ERROR and left out,
+    so importing never fails and the front ends can show the error"""
+    global MANIFEST_ERROR
+    try:
+        return dataset_specs(path)
+    except (ValueError, KeyError, OSError) as e:
+        MANIFEST_ERROR = f"{path}/{MANIFEST_FILE}: {e}"
+        print(f"ignoring {MANIFEST_ERROR}")
+        return {spec.name: spec for spec in BUILTIN_DATASETS}
+
+
+MANIFEST_ERROR = None  # why the manifest was ignored at import, None if it was read
+DATASETS = _import_specs()
+
+
+def use_manifest(path=r'datasets'):
+    """re-reads the registry for another datasets folder"""
+    DATASETS.clear()
+    DATASETS.update(dataset_specs(path))
+
+
+def eager_datasets():
+    return [name for name, spec in DATASETS.items() if spec.load == "eager"]
+
+
+def read_dataset(name, file_path):
+    """parses a dataset csv. long-form datasets return a frame sorted by gene with categorical labels and float32
+    values, wide ones a WideTable. prints the memory of the parsed frame and of the compact result"""
+    spec = DATASETS[name]
+    df = pd.read_csv(file_path)
+    before = df.memory_usage(deep=True).sum()
+    df = df.dropna(subset=[spec.id_vars[0]])  # rows without a gene can not be looked up
+    if spec.layout == "long":
+        table = compact_frame(df.sort_values(spec.id_vars[0], kind='stable').reset_index(drop=True), spec.value_name)
+        after = table.memory_usage(deep=True).sum()
+    else:
+        table = WideTable.from_frame(df, list(spec.id_vars), spec.var_name, spec.value_name)
+        after = table.nbytes
+    print(f"{name}: {before / 2 ** 20:.1f} MB -> {after / 2 ** 20:.1f} MB")
+    return table
+
+
+def load_dataset(name, path=r'datasets', use_cache=True, mmap=False):
+    """loads a single dataset according to its load policy, from its binary cache if the csv did not change.
+    returns a GeneTable for long-form datasets and a WideTable for gene x celltype matrices.
+    with mmap (or the mmap policy) the cached matrices are memory mapped read-only, so processes share one page-cache copy"""
+    with TIMINGS.timed("load", name):
+        return _load_dataset(name, path, use_cache, mmap)
+
+
+def _cache_tag(spec):
+    if spec.layout == "long":
+        return f'long.{spec.id_vars[0]}.categorical'
+    tag = WideTable.cache_tag(list(spec.id_vars), spec.var_name)
+    return tag + '.stream' if spec.load == "mmap" else tag
+
+
+def is_cached(name, path=r'datasets'):
+    """whether load_dataset would read the dataset from a valid binary cache, instead of parsing the csv"""
+    spec = DATASETS[name]
+    if spec.load == "lazy":
+        return False
+    file_path, tag = f'{path}/{spec.file}', _cache_tag(spec)
+    data_file, meta_file = cache.cache_paths(file_path, tag, ext=None if spec.layout == "long" else 'npy')
+    return os.path.exists(data_file) and cache.is_valid(file_path, meta_file, tag)
+
+
+def _load_dataset(name, path, use_cache, mmap):
+    spec = DATASETS[name]
+    file_path = f'{path}/{spec.file}'
+    use_cache = use_cache and spec.load != "lazy"
+    if spec.layout == "long":
+        if use_cache:
+            df = cache.cached_frame(file_path, partial(read_dataset, name), tag=_cache_tag(spec))
+        else:
+            df = read_dataset(name, file_path)
+        return GeneTable(df, spec.id_vars[0], presorted=True, var_name=spec.var_name, value_name=spec.value_name)
+    if not use_cache:
+        return read_dataset(name, file_path)
+    if spec.load == "mmap":
+        arrays, attrs = cache.cached_stream(file_path, partial(WideTable.stream_csv, id_vars=list(spec.id_vars), var_name=spec.var_name,
+                                                               value_name=spec.value_name, chunksize=STREAM_CHUNK_ROWS),
+                                            tag=_cache_tag(spec))
+        return WideTable.from_arrays(arrays, attrs)
+    arrays, attrs = cache.cached_arrays(file_path, lambda p: read_dataset(name, p).to_arrays(),
+                                        tag=_cache_tag(spec),
+                                        mmap_mode='r' if mmap or spec.load == "mmap" else None)
+    return WideTable.from_arrays(arrays, attrs)
+
+
+def import_datasets(path=r'datasets', use_cache=True, mmap=False):
+    """eagerly loads every dataset, returns {name: GeneTable / WideTable}"""
+    return {name: load_dataset(name, path, use_cache, mmap) for name in DATASETS}
+
+
+def lazy_datasets(path=r'datasets', use_cache=True, mmap=False):
+    """returns a DatasetRegistry that loads each dataset the first time it is used"""
+    return DatasetRegistry(DATASETS, partial(load_dataset, path=path, use_cache=use_cache, mmap=mmap))
+
+
+def build_cache(name, path=r'datasets'):
+    """parses the dataset's csv into its binary cache (run in a CacheBuilder worker). returns the seconds it took"""
+    start = time.perf_counter()
+    _load_dataset(name, path, use_cache=True, mmap=True)  # memory mapped: the worker does not keep the matrix
+    return time.perf_counter() - start
+
+
+class CacheBuilder:
+    """prepare step for DatasetRegistry.warm: datasets without a valid binary cache are parsed in worker processes,
+    so several csvs are parsed at once, and the warm-up threads then only read the caches.
+    the worker processes are started on the first stale cache and stopped by close(), or right away by cancel()"""
+
+    def __init__(self, path=r'datasets', processes=None, min_mb=PARSE_PROCESS_MB):
+        self.path = path
+        self.processes = processes or os.cpu_count()
+        self.min_bytes = min_mb * 2 ** 20
+        self._pool = None
+        self._cancelled = False
+        self._lock = threading.Lock()
+
+    def __call__(self, name):
+        spec = DATASETS[name]
+        if spec.load == "lazy" or os.path.getsize(f'{self.path}/{spec.file}') < self.min_bytes or is_cached(name, self.path):
+            return
+        with self._lock:
+            if self._cancelled:
+                return
+            if self._pool is None:
+                # spawn, not fork: the app forks from a process that already runs Tk and threads
+                self._pool = ProcessPoolExecutor(self.processes, mp_context=multiprocessing.get_context('spawn'),
+                                                 initializer=use_manifest, initargs=(self.path,))
+            future = self._pool.submit(build_cache, name, self.path)
+        try:
+            seconds = future.result()
+        except (BrokenProcessPool, CancelledError):
+            if self._cancelled:  # the parse was dropped by cancel()
+                return
+            raise
+        TIMINGS.record("parse", name, seconds)
+
+    def close(self):
+        """stops the worker processes once their parses are done, a later stale cache starts new ones"""
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False)
+                self._pool = None
+
+    def cancel(self):
+        """kills the worker processes, the parses they run are dropped and the threads waiting on them return.
+        a killed parse leaves no cache behind (the cache files are replaced atomically) and its scratch files are removed,
+        no parse starts after this"""
+        with self._lock:
+            self._cancelled = True
+            pool, self._pool = self._pool, None
+        if pool is None:
+            return
+        processes = list((getattr(pool, '_processes', None) or {}).values())  # shutdown forgets them
+        pool.shutdown(wait=False, cancel_futures=True)
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join(KILL_WAIT)
+        pids = [process.pid for process in processes if process.exitcode is not None]
+        cache_dirs = {os.path.dirname(cache.cache_paths(f'{self.path}/{spec.file}')[0]) for spec in DATASETS.values()}
+        for cache_dir in cache_dirs:
+            cache.remove_scratch(cache_dir, pids)
@@ -0,0 +1,279 @@
+import json
+import argparse
+import threading
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+import matplotlib
+matplotlib.use("Agg")
+import plot
+from timing import TIMINGS
+
+# local HTTP/JSON service around plot.py: one warm process that many scripts and users query, instead of each one
+# loading the datasets itself:
+#   python server.py --port 8050 --workers 4
+#   curl 'localhost:8050/genes?prefix=GAP'
+#   curl 'localhost:8050/expression?dataset=hpa&gene=GAPDH'
+#   curl -o gapdh.png 'localhost:8050/plot?dataset=ts_liver&gene=GAPDH'
+# endpoints (GET):
+#   /datasets                        the dataset registry
+#   /genes?prefix=&limit=            symbols (and aliases) starting with prefix, from the symbol index
+#   /genes?dataset=                  every gene of one dataset
+#   /expression?dataset=&gene=       the gene's rows of one dataset, as {column: values}
+#   /plot?dataset=&gene=&format=     the dataset's plot of the gene as png, svg or pdf. dataset=all compares every dataset
+#   /stats                           cache and timing statistics
+# errors are {"error": message} with status 400 (bad query), 404 (unknown dataset or gene) or 503 (busy, retry)
+
+PLOT_FORMATS = {"png": "image/png", "svg": "image/svg+xml", "pdf": "application/pdf"}
+COMPARE_DATASET = "all"  # /plot?dataset=all renders plot.compare_datasets
+MAX_CONCURRENT = 4  # requests doing lookups or renders at once, the others wait for a slot
+QUEUE_TIMEOUT = 10  # seconds a request waits for a slot before it is answered with 503
+RESPONSE_CACHE_ITEMS = 1024
+RESPONSE_CACHE_MB = 64
+RENDER_CACHE_MB = 256  # rendered plots kept on disk, shared with the CTk app (see plot.image_cache), 0 turns it off
+GENES_LIMIT = 50
+WARM_THREADS = 3  # datasets read at once by the background warm-up, csvs without a binary cache are parsed in processes
+STOP_TIMEOUT = 2  # seconds shutting down waits for the warm-up threads
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class ResponseCache:
+    """LRU cache of successful responses keyed on the endpoint and its sorted query, bounded by count and memory"""
+
+    def __init__(self, max_items=RESPONSE_CACHE_ITEMS, max_mb=RESPONSE_CACHE_MB):
+        self.max_items = max_items
+        self.max_bytes = max_mb * 2 ** 20
+        self.hits = self.misses = 0
+        self.nbytes = 0
+        self._responses = OrderedDict()  # key: (content type, body)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            response = self._responses.get(key)
+            if response is None:
+                self.misses += 1
+                return None
+            self._responses.move_to_end(key)
+            self.hits += 1
+            return response
+
+    def put(self, key, content_type, body):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._responses.pop(key, None)
+            if old is not None:
+                self.nbytes -= len(old[1])
+            self._responses[key] = (content_type, body)
+            self.nbytes += len(body)
+            while len(self._responses) > self.max_items or self.nbytes > self.max_bytes:
+                _, (_, evicted) = self._responses.popitem(last=False)
+                self.nbytes -= len(evicted)
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "responses": len(self._responses),
+                    "mb": round(self.nbytes / 2 ** 20, 1)}
+
+
+class PlotterServer(ThreadingHTTPServer):
+    """the datasets (memory mapped, warmed in the background), the symbol index, the render pool and the caches
+    shared by every request thread"""
+
+    daemon_threads = True
+
+    def __init__(self, address, path=r'datasets', workers=0, max_concurrent=MAX_CONCURRENT,
+                 cache_mb=RESPONSE_CACHE_MB, render_cache_mb=RENDER_CACHE_MB):
+        super().__init__(address, Handler)
+        plot.use_manifest(path)
+        self.datasets_path = path
+        self.datasets = plot.lazy_datasets(path, mmap=True)
+        self.symbols = plot.cached_symbol_index(path)
+        # workers > 0 renders in worker processes, which send back the encoded image. 0 renders in the request thread
+        self.pool = plot.render_pool(path, workers) if workers else None
+        self.image_cache = plot.image_cache(path, render_cache_mb) if render_cache_mb else None
+        self.responses = ResponseCache(max_mb=cache_mb)
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+        self.cache_builder = plot.CacheBuilder(path)
+        self.datasets.warm(then=self.build_symbol_index, threads=WARM_THREADS, prepare=self.cache_builder)
+
+    def build_symbol_index(self):
+        self.cache_builder.close()
+        if self.symbols is None:
+            self.symbols = plot.symbol_index(self.datasets, self.datasets_path)
+
+    def resolve(self, gene):
+        return gene.upper() if self.symbols is None else self.symbols.resolve(gene)
+
+    def table(self, name):
+        if name not in plot.DATASETS:
+            raise HTTPError(404, f"unknown dataset {name!r}")
+        return self.datasets[name]
+
+    def find(self, name, gene):
+        """the dataset's spelling of gene, HTTPError 404 if it lacks it. the symbol index answers misses without loading"""
+        gene = self.resolve(gene)
+        if self.symbols is not None and name in plot.DATASETS and not self.symbols.has(gene, name):
+            raise HTTPError(404, f"{gene} is not in {name}")
+        found = self.table(name).find(gene)
+        if found is None:
+            raise HTTPError(404, f"{gene} is not in {name}")
+        return found
+
+
+def _required(query, field):
+    value = query.get(field, "").strip()
+    if not value:
+        raise HTTPError(400, f"missing query parameter {field!r}")
+    return value
+
+
+def _json(obj):
+    return "application/json", json.dumps(obj).encode()
+
+
+def _values(values):
+    """json-safe list, NaN as null"""
+    return [None if value != value else value for value in values.tolist()]
+
+
+def get_datasets(server, query):
+    return _json([{"name": name, "label": spec.label, "organism": spec.organism, "organ": spec.organ, "kind": spec.kind,
+                   "paper_url": spec.paper_url, "loaded": server.datasets.is_loaded(name),
+                   "status": server.datasets.status.get(name, "not loaded")}
+                  for name, spec in plot.DATASETS.items()])
+
+
+def get_genes(server, query):
+    name = query.get("dataset")
+    if name:
+        return _json({"dataset": name, "genes": server.table(name).genes})
+    prefix = _required(query, "prefix")
+    try:
+        limit = int(query.get("limit", GENES_LIMIT))
+    except ValueError:
+        raise HTTPError(400, "limit must be an integer")
+    if server.symbols is None:
+        raise HTTPError(503, "the gene index is still being built")
+    return _json({"prefix": prefix, "genes": server.symbols.complete(prefix, limit)})
+
+
+def get_expression(server, query):
+    name = _required(query, "dataset")
+    gene = server.find(name, _required(query, "gene"))
+    with TIMINGS.timed("lookup", name):
+        rows = server.table(name).get(gene)
+    return _json({"dataset": name, "gene": gene, "columns": {col: _values(rows[col].to_numpy()) for col in rows.columns}})
+
+
+def get_plot(server, query):
+    name = _required(query, "dataset")
+    gene = _required(query, "gene")
+    fmt = query.get("format", "png").lower()
+    if fmt not in PLOT_FORMATS:
+        raise HTTPError(400, f"format must be one of {', '.join(PLOT_FORMATS)}")
+    if name == COMPARE_DATASET:
+        fig = plot.compare_datasets(server.datasets, server.resolve(gene), presence=server.symbols)
+        if fig is None:
+            raise HTTPError(404, f"no dataset has {gene}")
+        return PLOT_FORMATS[fmt], plot.figure_bytes(fig, fmt)
+    gene = server.find(name, gene)
+    spec = plot.DATASETS[name]
+    plot_fn, args = plot.PLOT_KINDS[spec.kind], plot.job_args(spec)
+    key = plot.image_key(name, plot_fn, args, gene, server.datasets_path)
+    body = None if server.image_cache is None else server.image_cache.get(key, fmt)
+    if body is None:
+        if server.pool is not None:
+            body = plot.submit_render_bytes(server.pool, name, plot_fn, args, gene, fmt).result()
+        else:
+            with TIMINGS.timed("figure", name):
+                fig = plot_fn(server.datasets[name], gene, *args)
+            body = None if fig is None else plot.figure_bytes(fig, fmt)
+        if body is None:
+            raise HTTPError(404, f"{gene} is not in {name}")
+        if server.image_cache is not None:
+            server.image_cache.put(key, body, fmt)
+    return PLOT_FORMATS[fmt], body
+
+
+def get_stats(server, query):
+    stats = {"responses": server.responses.stats(), "timings": TIMINGS.summary()}
+    if server.image_cache is not None:
+        stats["renders"] = server.image_cache.stats()
+    return _json(stats)
+
+
+ROUTES = {"/genes": get_genes, "/expression": get_expression, "/plot": get_plot}
+UNCACHED_ROUTES = {"/datasets": get_datasets, "/stats": get_stats}  # answers that change while the server runs
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        path = url.path.rstrip('/')
+        route = ROUTES.get(path) or UNCACHED_ROUTES.get(path)
+        if route is None:
+            return self.send_error_json(404, f"unknown endpoint {url.path!r}")
+        query = {field: values[-1] for field, values in parse_qs(url.query).items()}
+        key = (path, tuple(sorted(query.items())))
+        cached = self.server.responses.get(key) if path in ROUTES else None
+        if cached is not None:
+            return self.send_body(200, *cached)
+        if not self.server.slots.acquire(timeout=QUEUE_TIMEOUT):
+            return self.send_error_json(503, "too many requests, try again")
+        try:
+            content_type, body = route(self.server, query)
+        except HTTPError as e:
+            return self.send_error_json(e.status, str(e))
+        except Exception as e:
+            print(f"failed {self.path}: {e!r}")
+            return self.send_error_json(500, str(e))
+        finally:
+            self.server.slots.release()
+        if path in ROUTES:
+            self.server.responses.put(key, content_type, body)
+        self.send_body(200, content_type, body)
+
+    def send_body(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if status == 503:
+            self.send_header("Retry-After", "1")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, status, message):
+        self.send_body(status, *_json({"error": message}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="serve gene lookups and plots over HTTP")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8050)
+    parser.add_argument("--datasets", default="datasets", help="datasets folder")
+    parser.add_argument("--workers", type=int, default=0, help="render worker processes (default: render in the request threads)")
+    parser.add_argument("--max-concurrent", type=int, default=MAX_CONCURRENT, help="requests served at once, the others wait")
+    parser.add_argument("--cache-mb", type=int, default=RESPONSE_CACHE_MB, help="memory for cached responses")
+    args = parser.parse_args()
+
+    server = PlotterServer((args.host, args.port), args.datasets, args.workers, args.max_concurrent, args.cache_mb)
+    print(f"serving {len(plot.DATASETS)} datasets on http://{args.host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.datasets.stop(timeout=STOP_TIMEOUT)  # also kills a csv parse the warm-up waits on
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
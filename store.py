@@ -0,0 +1,462 @@
+import os
+import time
+import threading
+import numpy as np
+import pandas as pd
+
+SCALE_SAMPLE = 1_000_000  # values read for a table's scale, every n-th one of bigger tables
+SCALE_PERCENTILE = 99
+
+
+def gene_index(genes):
+    """{gene: (start, stop)} for an array of genes where each gene's rows are contiguous"""
+    if len(genes) == 0:
+        return {}
+    if isinstance(genes, pd.Categorical):  # boundaries on the integer codes, rows without a gene (code -1) are left out
+        return {genes.categories[code]: span for code, span in gene_index(genes.codes).items() if code >= 0}
+    starts = np.flatnonzero(np.r_[True, genes[1:] != genes[:-1]])
+    stops = np.r_[starts[1:], len(genes)]
+    return {gene: (int(start), int(stop)) for gene, start, stop in zip(genes[starts].tolist(), starts, stops)}
+
+
+class GeneIndexed:
+    """gene lookups shared by the table classes. subclasses set self.index = gene_index(...)"""
+
+    index = {}
+    _upper = None
+    _scale = None
+
+    def __contains__(self, gene):
+        return gene in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def genes(self):
+        return list(self.index)
+
+    def find(self, gene):
+        """returns the table's spelling of gene, matched case-insensitively, or None"""
+        if gene in self.index:
+            return gene
+        if self._upper is None:
+            self._upper = {g.upper(): g for g in self.index if isinstance(g, str)}
+        return self._upper.get(gene.upper())
+
+    def scale(self):
+        """the 99th percentile of the table's values, computed once. the unit for comparing one gene across datasets
+        with different value ranges, robust to a few extreme genes"""
+        if self._scale is None:
+            values = self._values().reshape(-1)
+            sample = values[::max(1, values.size // SCALE_SAMPLE)]
+            self._scale = float(np.nanpercentile(sample, SCALE_PERCENTILE)) if sample.size else 0.0
+        return self._scale
+
+    def _spans(self, genes):
+        """(found genes, row starts, row stops) for the genes that are in the table, in the given order"""
+        found = [gene for gene in dict.fromkeys(genes) if gene in self.index]
+        spans = np.array([self.index[gene] for gene in found], dtype=np.int64).reshape(-1, 2)
+        return found, spans[:, 0], spans[:, 1]
+
+
+def compact_frame(df, value_name):
+    """long-form frame with categorical label columns and float32 values. the frame must be sorted by gene,
+    so the gene codes stay contiguous"""
+    columns = {col: 'category' for col in df.columns if col != value_name and not pd.api.types.is_numeric_dtype(df[col])}
+    columns[value_name] = np.float32
+    return df.astype(columns)
+
+
+def row_positions(starts, stops):
+    """all row numbers of the given [start, stop) ranges, concatenated, without a python loop"""
+    lengths = stops - starts
+    offsets = np.r_[0, np.cumsum(lengths)[:-1]]
+    return np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())
+
+
+class GeneTable(GeneIndexed):
+    """long-form dataset sorted by gene, with a gene -> row slice index built once at load time"""
+
+    def __init__(self, df, gene_col='gene', presorted=False, var_name='celltype', value_name='expression'):
+        self.gene_col = gene_col
+        self.var_name = var_name
+        self.value_name = value_name
+        self.df = df if presorted else df.sort_values(gene_col, kind='stable').reset_index(drop=True)
+        genes = self.df[gene_col]
+        self.index = gene_index(genes.array if isinstance(genes.dtype, pd.CategoricalDtype) else genes.to_numpy())
+        # categorical columns are decoded in get(), plots order them by appearance and skip unused categories.
+        # column: (categories, codes) of a categorical column, (None, values) of any other. the categories end
+        # with a NaN, so the code -1 of a missing label decodes to NaN
+        self._columns = {}
+        if any(isinstance(dtype, pd.CategoricalDtype) for dtype in self.df.dtypes):
+            for col, values in self.df.items():
+                if isinstance(values.dtype, pd.CategoricalDtype):
+                    self._columns[col] = (np.append(np.asarray(values.cat.categories, dtype=object), np.nan),
+                                         values.cat.codes.to_numpy())
+                else:
+                    self._columns[col] = (None, values.to_numpy())
+
+    @property
+    def nbytes(self):
+        return int(self.df.memory_usage(deep=True).sum())
+
+    def _values(self):
+        return self.df[self.value_name].to_numpy()
+
+    def get(self, gene):
+        """returns the rows of gene, or None if the gene is missing (without touching the data)"""
+        span = self.index.get(gene)
+        if span is None:
+            return None
+        start, stop = span
+        if not self._columns:
+            return self.df.iloc[start:stop]
+        data = {col: values[start:stop] if categories is None else categories[values[start:stop]]
+                for col, (categories, values) in self._columns.items()}
+        return pd.DataFrame(data, index=pd.RangeIndex(start, stop), copy=False)
+
+    def matrix(self, genes):
+        """genes x var_name frame of value_name (averaged over duplicate rows) for the genes that are in the table"""
+        found, starts, stops = self._spans(genes)
+        rows = self.df.iloc[row_positions(starts, stops)]
+        wide = rows.pivot_table(index=self.gene_col, columns=self.var_name, values=self.value_name, aggfunc='mean', sort=False)
+        return wide.reindex(found)
+
+
+class WideTable(GeneIndexed):
+    """gene x column float32 matrix, rows sorted by gene, with a gene -> row slice index.
+    ids holds the extra per-row id columns (e.g. 'section'), var_name names the matrix columns in get()"""
+
+    def __init__(self, row_genes, values, columns, var_name, ids=None, value_name='expression'):
+        self.row_genes = row_genes
+        self.values = values
+        self.columns = columns
+        self.var_name = var_name
+        self.value_name = value_name
+        self.ids = ids or {}
+        self.index = gene_index(row_genes)
+
+    @classmethod
+    def from_frame(cls, df, id_vars, var_name, value_name='expression'):
+        """builds a WideTable from a wide csv frame with id_vars[0] being the gene column"""
+        gene_col, extra_ids = id_vars[0], id_vars[1:]
+        df = df.sort_values(gene_col, kind='stable')
+        value_cols = [col for col in df.columns if col not in id_vars]
+        ids = {col: _plain_array(df[col].to_numpy()) for col in extra_ids}
+        return cls(_plain_array(df[gene_col].astype(str).to_numpy()),
+                   np.ascontiguousarray(df[value_cols].to_numpy(dtype=np.float32)),
+                   np.array(value_cols, dtype=str), var_name, ids, value_name)
+
+    @staticmethod
+    def cache_tag(id_vars, var_name):
+        """cache tag naming the layout, so the same csv read with the same layout shares one cache"""
+        return '.'.join(['wide', *id_vars, var_name])
+
+    def to_arrays(self):
+        """(arrays, attrs) for storing the table as plain .npy files"""
+        arrays = {"row_genes": self.row_genes, "values": self.values, "columns": self.columns}
+        arrays.update({f"id_{col}": values for col, values in self.ids.items()})
+        attrs = {"var_name": self.var_name, "value_name": self.value_name, "ids": list(self.ids)}
+        return arrays, attrs
+
+    @staticmethod
+    def stream_csv(file_path, data_dir, id_vars, var_name, value_name='expression', chunksize=50_000):
+        """writes the arrays of to_arrays for a wide csv into data_dir as .npy files, reading the csv chunk by chunk,
+        so memory holds one chunk and the row labels, never the matrix. rows are sorted by gene like from_frame.
+        returns the attrs (see cache.cached_stream)"""
+        gene_col, extra_ids = id_vars[0], id_vars[1:]
+        unsorted_file = os.path.join(data_dir, 'values.unsorted')
+        genes, ids, value_cols = [], {col: [] for col in extra_ids}, None
+        with open(unsorted_file, 'wb') as f:
+            for chunk in pd.read_csv(file_path, chunksize=chunksize):
+                chunk = chunk.dropna(subset=[gene_col])  # like read_dataset, rows without a gene are left out
+                if value_cols is None:
+                    value_cols = [col for col in chunk.columns if col not in id_vars]
+                f.write(np.ascontiguousarray(chunk[value_cols].to_numpy(dtype=np.float32)).tobytes())
+                genes.append(_plain_array(chunk[gene_col].astype(str).to_numpy()))
+                for col in extra_ids:
+                    ids[col].append(_plain_array(chunk[col].to_numpy()))
+        row_genes = np.concatenate(genes)
+        order = np.argsort(row_genes, kind='stable')
+        shape = (len(row_genes), len(value_cols))
+        unsorted = np.memmap(unsorted_file, dtype=np.float32, mode='r', shape=shape) if shape[0] else np.empty(shape, np.float32)
+        values = np.lib.format.open_memmap(os.path.join(data_dir, 'values.npy'), mode='w+', dtype=np.float32, shape=shape)
+        for start in range(0, shape[0], chunksize):  # reorder by gene, one chunk of rows at a time
+            values[start:start + chunksize] = unsorted[order[start:start + chunksize]]
+        values.flush()
+        del values, unsorted  # unmapped before the file is removed
+        os.remove(unsorted_file)
+        np.save(os.path.join(data_dir, 'row_genes.npy'), row_genes[order])
+        np.save(os.path.join(data_dir, 'columns.npy'), np.array(value_cols, dtype=str))
+        for col, parts in ids.items():
+            np.save(os.path.join(data_dir, f'id_{col}.npy'), np.concatenate(parts)[order])
+        return {"var_name": var_name, "value_name": value_name, "ids": list(extra_ids)}
+
+    @classmethod
+    def from_arrays(cls, arrays, attrs):
+        ids = {col: arrays[f"id_{col}"] for col in attrs["ids"]}
+        return cls(arrays["row_genes"], arrays["values"], arrays["columns"], attrs["var_name"], ids, attrs["value_name"])
+
+    def _values(self):
+        return self.values
+
+    @property
+    def nbytes(self):
+        return self.row_genes.nbytes + self.values.nbytes + self.columns.nbytes + sum(v.nbytes for v in self.ids.values())
+
+    def rows(self, gene):
+        """returns the matrix rows of gene (a view, no copy even when memory mapped), or None if missing"""
+        span = self.index.get(gene)
+        if span is None:
+            return None
+        return self.values[span[0]:span[1]]
+
+    def get(self, gene):
+        """returns the rows of gene as a small long-form frame (same layout as pd.melt), or None if missing"""
+        span = self.index.get(gene)
+        if span is None:
+            return None
+        rows = self.values[span[0]:span[1]]
+        n_rows, n_cols = rows.shape
+        out = {"gene": np.full(n_rows * n_cols, gene, dtype=object)}
+        for col, values in self.ids.items():
+            out[col] = np.tile(values[span[0]:span[1]], n_cols)
+        out[self.var_name] = np.repeat(self.columns, n_rows)
+        out[self.value_name] = rows.T.ravel()  # column major, like melt
+        return pd.DataFrame(out)
+
+    def matrix(self, genes):
+        """genes x columns frame for the genes that are in the table, one fancy-indexed read of the matrix.
+        genes with several rows (extra ids such as 'section') are averaged over them"""
+        found, starts, stops = self._spans(genes)
+        lengths = stops - starts
+        if (lengths == 1).all():
+            values = self.values[starts]
+        else:
+            offsets = np.r_[0, np.cumsum(lengths)[:-1]]
+            values = np.add.reduceat(self.values[row_positions(starts, stops)], offsets, axis=0) / lengths[:, None]
+        return pd.DataFrame(values, index=pd.Index(found, name='gene'), columns=self.columns)
+
+
+def _plain_array(values):
+    """object arrays are saved as fixed-width strings so the .npy files load without pickle"""
+    return values.astype(str) if values.dtype == object else values
+
+
+class DatasetRegistry:
+    """dict-like {name: GeneTable / WideTable} that loads each dataset on first access.
+    status holds 'queued', 'loading', 'loaded' or 'failed' per dataset that was warmed or used"""
+
+    def __init__(self, names, loader):
+        self.names = list(names)
+        self.loader = loader
+        self.status = {}
+        self._tables = {}
+        self._locks = {name: threading.Lock() for name in self.names}
+        self._queue = []  # datasets waiting for the warm-up threads, first is loaded next
+        self._queue_lock = threading.Lock()
+        self._warm_threads = []
+        self._prepare = None
+        self._stopped = False
+
+    def __getitem__(self, name):
+        table = self._tables.get(name)
+        if table is not None:
+            return table
+        with self._locks[name]:  # KeyError for unknown names, like a dict
+            if name not in self._tables:
+                self.status[name] = 'loading'
+                try:
+                    self._tables[name] = self.loader(name)
+                except Exception:
+                    self.status[name] = 'failed'
+                    raise
+                self.status[name] = 'loaded'
+            return self._tables[name]
+
+    def __contains__(self, name):
+        return name in self._locks
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def keys(self):
+        return list(self.names)
+
+    def items(self):
+        return [(name, self[name]) for name in self.names]
+
+    def is_loaded(self, name):
+        return name in self._tables
+
+    @property
+    def loaded(self):
+        return [name for name in self.names if name in self._tables]
+
+    def warm(self, names=None, background=True, then=None, threads=1, prepare=None):
+        """loads the given (default: all) datasets that are not loaded yet, on threads daemon threads if background,
+        in queue order (see prioritize). queries meanwhile load what they need themselves, or wait for the dataset
+        a warm-up thread is loading. prepare(name) runs on the thread before each load, e.g. to build the binary
+        cache in another process. then() is called (on the last thread to finish) once the queue is empty"""
+        names = self.names if names is None else names
+        with self._queue_lock:
+            self._stopped = False
+            self._prepare = prepare
+            for name in names:
+                if name not in self._tables and name not in self._queue:
+                    self._queue.append(name)
+                    self.status[name] = 'queued'
+        running = [threads if background else 1]
+
+        def _load_queued():
+            while True:
+                with self._queue_lock:
+                    if not self._queue:
+                        break
+                    name = self._queue.pop(0)
+                try:
+                    if prepare is not None and name not in self._tables:
+                        self.status[name] = 'loading'
+                        prepare(name)
+                        if self._stopped:  # cancelled while preparing
+                            break
+                    self[name]
+                except Exception as e:  # a broken file should not stop the others from loading
+                    self.status[name] = 'failed'
+                    print(f"failed loading {name}: {e}")
+            with self._queue_lock:
+                running[0] -= 1
+                last = running[0] == 0
+            if last and then is not None and not self._stopped:
+                then()
+
+        if not background:
+            _load_queued()
+            return []
+        self._warm_threads = [threading.Thread(target=_load_queued, name=f"dataset-warmup-{i}", daemon=True)
+                              for i in range(threads)]
+        for thread in self._warm_threads:
+            thread.start()
+        return self._warm_threads
+
+    def stop(self, timeout=None):
+        """empties the warm-up queue, cancels the prepare step (if it has a cancel method, see registry.CacheBuilder)
+        and waits up to timeout seconds for the threads to finish the datasets they are loading. then() is not called.
+        call it before exiting: a daemon thread killed inside a read can hang the interpreter's shutdown.
+        returns False if a thread is still running"""
+        with self._queue_lock:
+            self._stopped = True
+            for name in self._queue:
+                self.status.pop(name, None)
+            self._queue.clear()
+        cancel = getattr(self._prepare, 'cancel', None)
+        if cancel is not None:
+            cancel()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in self._warm_threads:
+            if thread is not threading.current_thread():
+                thread.join(None if deadline is None else max(0, deadline - time.monotonic()))
+        return not any(thread.is_alive() for thread in self._warm_threads if thread is not threading.current_thread())
+
+    def prioritize(self, names):
+        """moves the given datasets to the front of the warm-up queue, in the given order"""
+        with self._queue_lock:
+            first = [name for name in names if name in self._queue]
+            self._queue = first + [name for name in self._queue if name not in first]
+
+    def progress(self):
+        """(loaded, total, loading) of the datasets that were warmed or used, loading: their names"""
+        status = dict(self.status)
+        loading = [name for name in self.names if status.get(name) == 'loading']
+        return sum(state in ('loaded', 'failed') for state in status.values()), len(status), loading
+
+
+def load_aliases(file_path):
+    """{alias: symbol} from an optional csv with columns alias, symbol ({} if the file does not exist)"""
+    if not os.path.exists(file_path):
+        return {}
+    df = pd.read_csv(file_path)
+    return dict(zip(df['alias'].astype(str), df['symbol'].astype(str)))
+
+
+class SymbolIndex:
+    """sorted array of the upper-cased gene symbols (and aliases) of a set of datasets, with a symbols x datasets
+    presence bitmap. prefix completion and membership are binary searches, no dataset is touched"""
+
+    def __init__(self, names, symbols, bits, aliases=None):
+        self.names = list(names)
+        self.symbols = symbols
+        self.bits = bits  # np.packbits of the symbols x datasets presence matrix, one row per symbol
+        self.aliases = aliases or {}
+        self._columns = {name: j for j, name in enumerate(self.names)}
+
+    @classmethod
+    def from_tables(cls, tables, aliases=None):
+        names = list(tables)
+        upper = {name: np.char.upper(np.array(table.genes, dtype=str)) for name, table in tables.items()}
+        aliases = {alias.upper(): symbol.upper() for alias, symbol in (aliases or {}).items()}
+        symbols = set(aliases)
+        for genes in upper.values():
+            symbols.update(genes.tolist())
+        symbols = np.array(sorted(symbols), dtype=str)
+        presence = np.zeros((len(symbols), len(names)), dtype=bool)
+        for j, genes in enumerate(upper.values()):
+            presence[np.searchsorted(symbols, genes), j] = True
+        kept = {}
+        for alias, symbol in aliases.items():
+            target = np.searchsorted(symbols, symbol)
+            if target < len(symbols) and symbols[target] == symbol and alias != symbol:
+                kept[alias] = symbol
+                presence[np.searchsorted(symbols, alias)] |= presence[target]
+        return cls(names, symbols, np.packbits(presence, axis=1), kept)
+
+    def to_arrays(self):
+        """(arrays, attrs) for storing the index as plain .npy files"""
+        return {"symbols": self.symbols, "bits": self.bits}, {"names": self.names, "aliases": self.aliases}
+
+    @classmethod
+    def from_arrays(cls, arrays, attrs):
+        return cls(attrs["names"], arrays["symbols"], arrays["bits"], attrs["aliases"])
+
+    def _position(self, symbol):
+        i = int(np.searchsorted(self.symbols, symbol))
+        return i if i < len(self.symbols) and self.symbols[i] == symbol else None
+
+    def __contains__(self, symbol):
+        return self._position(symbol.upper()) is not None
+
+    def __len__(self):
+        return len(self.symbols)
+
+    def resolve(self, symbol):
+        """upper-cased symbol, with aliases replaced by the symbol they stand for"""
+        symbol = symbol.upper()
+        return self.aliases.get(symbol, symbol)
+
+    def complete(self, prefix, limit=10):
+        """up to limit symbols starting with prefix, in sorted order"""
+        prefix = prefix.upper()
+        if not prefix:
+            return []
+        start = int(np.searchsorted(self.symbols, prefix, side='left'))
+        stop = int(np.searchsorted(self.symbols, prefix + '\uffff', side='left'))
+        return self.symbols[start:min(stop, start + limit)].tolist()
+
+    def has(self, symbol, name):
+        """whether dataset name holds symbol. datasets the index does not know are assumed to hold it"""
+        j = self._columns.get(name)
+        if j is None:
+            return True
+        i = self._position(symbol.upper())
+        return i is not None and bool(self.bits[i, j >> 3] & (0x80 >> (j & 7)))
+
+    def datasets_of(self, symbol):
+        """names of the datasets that hold symbol (or the gene it is an alias of)"""
+        i = self._position(symbol.upper())
+        if i is None:
+            return []
+        return [self.names[j] for j in np.flatnonzero(np.unpackbits(self.bits[i], count=len(self.names)))]
@@ -1,7 +1,15 @@
+import time
 import streamlit as st
 import pandas as pd
-import plotly.express as px
+import numpy as np
+import plotly.graph_objects as go
+import plotly.io as pio
 from pathlib import Path
+import registry
+import cache
+import plot
+from store import WideTable, SymbolIndex, DatasetRegistry
+from timing import TIMINGS
 
 # -------------------- Page/App title & credit --------------------
 st.set_page_config(page_title="Roy plotter", layout="wide", page_icon="icon.ico")
@@ -18,26 +26,52 @@ st.markdown("""
 
 # -------------------- Config & helpers --------------------
 DATASETS_DIR = Path("datasets")
-MANIFEST_PATH = DATASETS_DIR / "manifest.csv"
+MANIFEST_PATH = DATASETS_DIR / registry.MANIFEST_FILE
+BAR_KINDS = ("bar", "hpa")  # plot kinds that are one value per celltype, the section line plots are CTk only
+RENDER_CACHE_MB = 256  # plotly figures kept on disk next to the CTk app's rendered plots, 0 turns it off
+EXPR_CACHE_ENTRIES = 512  # (dataset, gene) expression vectors kept in memory by the server
+FIGURE_CACHE_ENTRIES = 256  # bar figures kept in memory by the server, shared by every session
+BAR_COLOR = "#636efa"  # plotly's first color, what px.bar used
 
 @st.cache_data
 def load_manifest(path: Path) -> pd.DataFrame:
-    mf = pd.read_csv(path)
-    needed = {"file", "organism", "organ", "dataset_name", "paper_url"}
-    missing = needed - set(mf.columns)
-    if missing:
-        raise ValueError(f"manifest.csv missing columns: {missing}")
-    for col in ["file", "organism", "organ", "dataset_name", "paper_url"]:
-        mf[col] = mf[col].astype(str)
-    return mf
+    """the dataset registry shared with the CTk app (built-in datasets + manifest.csv), one row per dataset"""
+    specs = registry.dataset_specs(str(path.parent))
+    mf = pd.DataFrame([spec._asdict() for spec in specs.values() if spec.kind in BAR_KINDS])
+    return mf.rename(columns={"label": "dataset_name"})
 
-@st.cache_data
-def load_dataset_csv(path: Path) -> pd.DataFrame:
-    df = pd.read_csv(path)
-    if "gene" not in df.columns:
-        raise ValueError(f"{path.name} must have a 'gene' column.")
-    df["gene"] = df["gene"].astype(str)
-    return df
+@st.cache_resource
+def load_table(name: str):
+    # loaded according to the dataset's load policy, wide matrices memory mapped read-only from their cache:
+    # every session shares this object and every server process shares the page cache
+    return registry.load_dataset(name, str(DATASETS_DIR), mmap=True)
+
+@st.cache_resource
+def load_image_cache():
+    """on-disk cache of the bar figure specs, shared by every session and server process"""
+    return cache.ImageCache(str(DATASETS_DIR / cache.CACHE_DIR / "renders"), RENDER_CACHE_MB) if RENDER_CACHE_MB else None
+
+@st.cache_resource
+def load_symbol_index() -> SymbolIndex:
+    """symbols and presence bitmap of every registry dataset, saved by whichever process built them last (the CTk app
+    too), so no dataset is loaded for it. rebuilt from every dataset, and saved, only when a dataset csv changed"""
+    index = plot.cached_symbol_index(str(DATASETS_DIR))
+    if index is not None:
+        return index
+    tables = {}
+    for name in registry.DATASETS:
+        try:
+            tables[name] = load_table(name)
+        except Exception:  # reported when the dataset is selected
+            pass
+    return plot.symbol_index(tables, str(DATASETS_DIR))
+
+def found_in(gene: str) -> list:
+    return [labels[name] for name in symbols.datasets_of(symbols.resolve(gene)) if name in labels]
+
+def not_found_text(gene: str, where: str) -> str:
+    found = found_in(gene)
+    return f"No data for gene: {gene}{where}." + (f" Found in: {', '.join(found)}" if found else "")
 
 def filter_manifest(mf: pd.DataFrame, organism: str | None = None, organ: str | None = None) -> pd.DataFrame:
     out = mf
@@ -47,16 +81,74 @@ def filter_manifest(mf: pd.DataFrame, organism: str | None = None, organ: str |
         out = out[out["organ"] == organ]
     return out
 
-def build_expr_df(row: pd.Series) -> pd.DataFrame:
-    out = row.drop(labels="gene").reset_index()
-    out.columns = ["celltype", "expression"]
-    return out
+def build_expr_df(table: WideTable, row) -> pd.DataFrame:
+    return pd.DataFrame({"celltype": table.columns, "expression": row})
+
+def bar_figure(expr_df: pd.DataFrame, title: str):
+    # a bare go.Bar without a template: px.bar and its default template are most of the json sent to the browser,
+    # the values go out as float32 binary
+    fig = go.Figure(go.Bar(x=expr_df["celltype"].tolist(), y=np.asarray(expr_df["expression"], dtype=np.float32),
+                           marker_color=BAR_COLOR, hovertemplate="%{x}: %{y}<extra></extra>"))
+    fig.update_layout(
+        template="none",
+        title=dict(text=title, x=0.5, xanchor="center"),
+        font=dict(color="black"),
+        paper_bgcolor="white",
+        plot_bgcolor="white",
+        xaxis_showgrid=False,
+        yaxis_showgrid=False,
+        margin=dict(l=10, r=10, t=20, b=10)
+    )
+    fig.update_xaxes(title_text=None, tickfont=dict(color="black"))
+    fig.update_yaxes(
+        title=dict(text="Expression", font=dict(color="black")),
+        tickfont=dict(color="black")
+    )
+    return fig
+
+@st.cache_data(max_entries=EXPR_CACHE_ENTRIES)
+def cached_expr_df(name: str, gene: str):
+    """gene_expr_df of a loaded dataset, computed once per (dataset, gene) for every session"""
+    return gene_expr_df(load_table(name), gene, name)
 
-def find_gene_row(df: pd.DataFrame, gene: str):
+@st.cache_resource(max_entries=FIGURE_CACHE_ENTRIES)
+def cached_bar_figure(name: str, file: str, gene: str, title: str):
+    """the bar figure of a gene, from memory, else from the on-disk render cache, else built.
+    the dataset csv's mtime and size are part of the disk key, so an edited dataset addresses new files.
+    shared read-only by every session, so reruns that keep the dataset and gene rebuild nothing"""
+    image_cache = load_image_cache()
+    source = cache.source_key(str(DATASETS_DIR / file))
+    fig_key = [name, [source["mtime"], source["size"]], "plotly.go.bar", gene, title]
+    fig_json = image_cache.get(fig_key, ext="json") if image_cache is not None else None
+    if fig_json is not None:
+        return pio.from_json(fig_json.decode())
+    build_start = time.perf_counter()
+    fig = bar_figure(cached_expr_df(name, gene), title)
+    TIMINGS.record("figure", name, time.perf_counter() - build_start)
+    if image_cache is not None:
+        image_cache.put(fig_key, fig.to_json().encode(), ext="json")
+    return fig
+
+def gene_expr_df(table, gene: str, name: str = ""):
+    """returns the gene's expression per celltype, or None. a single-row wide gene reads a view of the mapped matrix"""
     if not gene:
         return None
-    m = df[df["gene"].str.upper() == gene.upper()]
-    return None if m.empty else m.iloc[0]
+    with TIMINGS.timed("lookup", name):
+        return _gene_expr_df(table, gene)
+
+def _gene_expr_df(table, gene: str):
+    found = table.find(gene)
+    if found is None:
+        return None
+    if isinstance(table, WideTable) and not table.ids:
+        return build_expr_df(table, table.rows(found)[0])
+    gene_df = table.get(found)
+    return pd.DataFrame({"celltype": gene_df[table.var_name].to_numpy(), "expression": gene_df[table.value_name].to_numpy()})
+
+@st.cache_resource(max_entries=FIGURE_CACHE_ENTRIES)
+def cached_compare_figure(gene: str, names: tuple):
+    """plot.compare_datasets of gene over the datasets, loading only the ones the symbol index says hold it"""
+    return plot.compare_datasets(DatasetRegistry(names, load_table), gene, list(names), presence=symbols)
 
 def _trigger_compute():
     st.session_state["trigger_compute"] = True
@@ -68,6 +160,9 @@ except Exception as e:
     st.error(f"Could not load manifest at {MANIFEST_PATH}:\n{e}")
     st.stop()
 
+symbols = load_symbol_index()
+labels = dict(zip(manifest["name"], manifest["dataset_name"]))
+
 # -------------------- Dropdowns row: organism → organ → dataset --------------------
 c1, c2, c3 = st.columns(3)
 with c1:
@@ -88,7 +183,7 @@ with c3:
 # Resolve selected dataset row
 selected_row = mf_oo[mf_oo["dataset_name"] == sel_dataset_name].iloc[0] if not mf_oo.empty else None
 paper_url = selected_row["paper_url"] if selected_row is not None else None
-ds_path = DATASETS_DIR / selected_row["file"] if selected_row is not None else None
+ds_name = selected_row["name"] if selected_row is not None else None
 
 # -------------------- Gene entry + button --------------------
 if "current_gene_input" not in st.session_state:
@@ -108,15 +203,23 @@ with c_btn:
     submitted = st.button("Show")
     submitted = submitted or st.session_state.pop("trigger_compute", False)
 
+# suggestions and dataset membership of what was typed, straight from the symbol index
+typed = (st.session_state.get("current_gene_input") or "").strip()
+if typed:
+    suggestions = [s for s in symbols.complete(typed, limit=8) if s != typed.upper()]
+    found = found_in(typed)
+    st.caption((f"Found in: {', '.join(found)}" if found else f"{typed.upper()} is not in any dataset")
+               + (f" · Did you mean: {', '.join(suggestions)}" if suggestions else ""))
+
 
 
 # -------------------- Load current dataset --------------------
-current_df = None
-if ds_path is not None:
+current_table = None
+if ds_name is not None:
     try:
-        current_df = load_dataset_csv(ds_path)
+        current_table = load_table(ds_name)
     except Exception as e:
-        st.error(f"Failed to load dataset '{sel_dataset_name}' ({ds_path.name}): {e}")
+        st.error(f"Failed to load dataset '{sel_dataset_name}' ({selected_row['file']}): {e}")
         st.stop()
 
 
@@ -125,35 +228,31 @@ if dataset_changed:
     st.session_state["dataset_name"] = sel_dataset_name  # remember last dataset
 
 # 1) If user submitted, use their input
-if submitted and current_df is not None:
-    g = (st.session_state.get("current_gene_input") or "").strip()
-    row = find_gene_row(current_df, g)
-    if row is None:
-        st.session_state["bar_expr_df"] = None
-        st.session_state["bar_warning"] = f"No data for gene: {g}"
-    else:
-        st.session_state["bar_expr_df"] = build_expr_df(row)
-        st.session_state["bar_warning"] = None
+if submitted and current_table is not None:
+    g = symbols.resolve((st.session_state.get("current_gene_input") or "").strip())
+    expr_df = cached_expr_df(ds_name, g)
+    st.session_state["bar_expr_df"] = expr_df
+    st.session_state["bar_gene"] = g
+    st.session_state["bar_warning"] = not_found_text(g, "") if expr_df is None else None
 
 # 2) Else if dataset changed, recompute using the SAME gene (if any)
-elif dataset_changed and current_df is not None:
-    g = (st.session_state.get("current_gene_input") or "").strip()
-    row = find_gene_row(current_df, g) if g else None
-    if row is None:
-        st.session_state["bar_expr_df"] = None
-        st.session_state["bar_warning"] = f"'{g}' not found in {sel_dataset_name}." if g else None
-    else:
-        st.session_state["bar_expr_df"] = build_expr_df(row)
-        st.session_state["bar_warning"] = None
+elif dataset_changed and current_table is not None:
+    g = symbols.resolve((st.session_state.get("current_gene_input") or "").strip())
+    expr_df = cached_expr_df(ds_name, g)
+    st.session_state["bar_expr_df"] = expr_df
+    st.session_state["bar_gene"] = g
+    st.session_state["bar_warning"] = not_found_text(g, f" in {sel_dataset_name}") if expr_df is None and g else None
 
 # 3) Else first-load default
-elif current_df is not None and st.session_state.get("bar_expr_df") is None and st.session_state.get("bar_warning") is None:
+elif current_table is not None and st.session_state.get("bar_expr_df") is None and st.session_state.get("bar_warning") is None:
     init_gene = (st.session_state.get("current_gene_input") or "GAPDH").strip()
-    row = find_gene_row(current_df, init_gene)
-    if row is None and not current_df.empty:
-        row = current_df.iloc[0]
-    if row is not None:
-        st.session_state["bar_expr_df"] = build_expr_df(row)
+    expr_df = cached_expr_df(ds_name, init_gene)
+    if expr_df is None and len(current_table):
+        init_gene = current_table.genes[0]
+        expr_df = cached_expr_df(ds_name, init_gene)
+    if expr_df is not None:
+        st.session_state["bar_expr_df"] = expr_df
+        st.session_state["bar_gene"] = init_gene
     else:
         st.session_state["bar_warning"] = "No data available in this dataset."
 
@@ -163,24 +262,30 @@ if st.session_state.get("bar_warning"):
     st.warning(st.session_state["bar_warning"])
 elif st.session_state.get("bar_expr_df") is not None:
     gene_title = (st.session_state.get("current_gene_input") or "").upper()
-    fig_bar = px.bar(st.session_state["bar_expr_df"], x="celltype", y="expression")
-    fig_bar.update_layout(
-        title=dict(text=gene_title, x=0.5, xanchor="center"),
-        font=dict(color="black"),
-        paper_bgcolor="white",
-        plot_bgcolor="white",
-        xaxis_showgrid=False,
-        yaxis_showgrid=False,
-        margin=dict(l=10, r=10, t=20, b=10)
-    )
-    fig_bar.update_xaxes(title_text=None, tickfont=dict(color="black"))
-    fig_bar.update_yaxes(
-        title=dict(text="Expression", font=dict(color="black")),
-        tickfont=dict(color="black")
-    )
-    st.plotly_chart(fig_bar, use_container_width=True)
+    fig_bar = cached_bar_figure(ds_name, selected_row["file"], st.session_state.get("bar_gene"), gene_title)
+    with TIMINGS.timed("draw", ds_name):
+        st.plotly_chart(fig_bar, use_container_width=True)
 
     if paper_url and isinstance(paper_url, str) and paper_url.strip():
         st.markdown(f"[Reference for **{sel_dataset_name}**]({paper_url})")
 else:
     st.info("Choose organism, organ, dataset, enter a gene, and press **Show** (or hit Enter).")
+
+# -------------------- All datasets --------------------
+if st.checkbox("Compare across all datasets", key="compare_all"):
+    compare_gene = st.session_state.get("bar_gene")
+    fig_all = cached_compare_figure(compare_gene, tuple(manifest["name"])) if compare_gene else None
+    if fig_all is None:
+        st.info(f"No dataset has {compare_gene}." if compare_gene else "Enter a gene to compare it across datasets.")
+    else:
+        st.pyplot(fig_all)
+
+# -------------------- Diagnostics --------------------
+with st.sidebar.expander("Diagnostics"):
+    # timings of every session served by this process
+    timing_rows = TIMINGS.summary()
+    if timing_rows:
+        st.dataframe(pd.DataFrame(timing_rows), hide_index=True)
+    else:
+        st.caption("No timings yet.")
+    st.download_button("Export timings (JSON)", TIMINGS.to_json(), file_name="timings.json", mime="application/json")
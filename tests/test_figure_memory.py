@@ -0,0 +1,51 @@
+import gc
+import os
+import sys
+import matplotlib
+matplotlib.use("Agg")
+from matplotlib.figure import Figure
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import benchmark
+import plot
+import registry
+
+# steady-state memory of the render path: 1,000 distinct-gene queries through plot.render and the figure cache
+# must not keep more figures alive than the cache holds, nor grow the python heap once the cache is full:
+#   python -m pytest -q tests
+
+QUERIES = 1000
+CACHE_ITEMS = 32
+WARMUP_QUERIES = 200  # the cache is full and every allocation pattern was seen once
+MAX_GROWTH = 0.05  # growth of live objects and heap blocks allowed from WARMUP_QUERIES to QUERIES
+
+
+def heap():
+    """(live figures, gc-tracked objects, allocated heap blocks) after a full collection"""
+    gc.collect()
+    objects = gc.get_objects()
+    return sum(isinstance(obj, Figure) for obj in objects), len(objects), sys.getallocatedblocks()
+
+
+def test_figure_memory_is_bounded(tmp_path):
+    directory = str(tmp_path)
+    registry.use_manifest(directory)
+    figure_cache = plot.FigureCache(max_items=CACHE_ITEMS)
+    try:
+        benchmark.make_datasets(directory, QUERIES + 3, 12)
+        name = next(name for name, spec in registry.DATASETS.items() if spec.kind == "bar" and spec.layout == "wide")
+        spec = registry.DATASETS[name]
+        datasets = {name: registry.load_dataset(name, directory)}
+        before = heap()[0]
+        for i, gene in enumerate(datasets[name].genes[:QUERIES]):
+            if i == WARMUP_QUERIES:
+                warm = heap()
+            assert plot.render(name, plot.bar, plot.job_args(spec), gene, datasets, figure_cache) is not None
+        figures, objects, blocks = heap()
+        assert figure_cache.stats()["figures"] == CACHE_ITEMS
+        assert figures - before <= CACHE_ITEMS
+        assert objects < warm[1] * (1 + MAX_GROWTH), f"{objects - warm[1]} more live objects"
+        assert blocks < warm[2] * (1 + MAX_GROWTH), f"{blocks - warm[2]} more heap blocks"
+    finally:
+        figure_cache.clear()
+        registry.use_manifest()
@@ -0,0 +1,30 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from store import GeneTable, compact_frame, gene_index
+
+# rows without a gene or a label: the gene index leaves them out and get() decodes a missing label to NaN
+
+
+def long_frame():
+    df = pd.DataFrame({"gene": [None, "a", "a", "b"], "celltype": ["c1", "c1", "c2", "c2"],
+                       "organ": ["o1", None, "o2", "o3"], "expression": [1., 2., 3., 4.]})
+    return compact_frame(df.sort_values("gene", kind="stable", na_position="first").reset_index(drop=True), "expression")
+
+
+def test_gene_index_skips_missing_genes():
+    genes = pd.Categorical([None, "a", "a", "b"])
+    assert gene_index(genes) == {"a": (1, 3), "b": (3, 4)}
+
+
+def test_get_decodes_missing_label_to_nan():
+    table = GeneTable(long_frame(), presorted=True)
+    assert table.get(None) is None
+    rows = table.get("a")
+    assert rows["celltype"].tolist() == ["c1", "c2"]
+    assert pd.isna(rows["organ"].iloc[0]) and rows["organ"].iloc[1] == "o2"
+    assert np.allclose(rows["expression"], [2., 3.])
+    assert table.get("b")["organ"].tolist() == ["o3"]
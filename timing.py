@@ -0,0 +1,75 @@
+import json
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+# per-stage, per-dataset timings of this process, shown by the CTk app and the Streamlit version.
+# stages: load, parse (csv to binary cache, in a warm-up process), lookup, figure, tight_layout, draw, save
+
+BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]  # histogram upper bounds, the last bucket is open
+BARS = " ▁▂▃▄▅▆▇█"
+
+
+def histogram_text(counts):
+    """one character per bucket, scaled to the fullest bucket"""
+    peak = max(counts) or 1
+    return ''.join(BARS[-1 if count == peak else (count * (len(BARS) - 1) + peak - 1) // peak] for count in counts)
+
+
+class Timings:
+    """thread-safe histograms of how long each (stage, dataset) took"""
+
+    def __init__(self):
+        self._stats = {}  # (stage, name): [count, total seconds, max seconds, bucket counts]
+        self._lock = threading.Lock()
+        self._current = threading.local()
+
+    def record(self, stage, name, seconds):
+        with self._lock:
+            stats = self._stats.get((stage, name))
+            if stats is None:
+                stats = self._stats[(stage, name)] = [0, 0.0, 0.0, [0] * (len(BUCKETS_MS) + 1)]
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+            stats[3][bisect.bisect_left(BUCKETS_MS, seconds * 1000)] += 1
+
+    @contextmanager
+    def timed(self, stage, name=None):
+        """times the block. without a name the stage is filed under the dataset of the enclosing timed block"""
+        outer = getattr(self._current, 'name', None)
+        name = outer if name is None else name
+        self._current.name = name
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, name or '', time.perf_counter() - start)
+            self._current.name = outer
+
+    def summary(self):
+        """[{stage, dataset, count, mean_ms, max_ms, histogram}], slowest mean first. histogram: see histogram_text"""
+        with self._lock:
+            rows = [{"stage": stage, "dataset": name, "count": count, "mean_ms": round(total / count * 1000, 2),
+                     "max_ms": round(peak * 1000, 2), "histogram": histogram_text(buckets)}
+                    for (stage, name), (count, total, peak, buckets) in self._stats.items()]
+        return sorted(rows, key=lambda row: -row["mean_ms"])
+
+    def to_json(self):
+        with self._lock:
+            stats = [{"stage": stage, "dataset": name, "count": count, "total_s": total, "max_s": peak,
+                      "histogram_ms": dict(zip([f"<={b}" for b in BUCKETS_MS] + [f">{BUCKETS_MS[-1]}"], buckets))}
+                     for (stage, name), (count, total, peak, buckets) in self._stats.items()]
+        return json.dumps({"buckets_ms": BUCKETS_MS, "timings": stats}, indent=1)
+
+    def export(self, file_path):
+        with open(file_path, 'w') as f:
+            f.write(self.to_json())
+
+    def clear(self):
+        with self._lock:
+            self._stats.clear()
+
+
+TIMINGS = Timings()